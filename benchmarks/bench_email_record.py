@@ -0,0 +1,77 @@
+"""
+Measures memory per recipient of prepared emails and their compact details, as dicts and as slotted records.
+
+Usage (from the repository root):
+python benchmarks/bench_email_record.py
+"""
+import hashlib
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from image_link import make_image_links
+from prepared_email import Email_Metadata, Prepared_Email, attach_transparent_image
+
+COLUMNS = ['email', 'name', 'department', 'field1']
+RECIPIENTS = 50_000
+BODY = '<html><body>Dear {name}, welcome to {department}. ' + 'x' * 2000 + '</body></html>'
+
+def make_rows():
+    return [(f'user{i}@example.com', f'User {i}', f'department-{i % 10}', f'value {i}') for i in range(RECIPIENTS)]
+
+def render(values):
+    subject = f'Hello {values[1]}'
+    body = BODY.format(name=values[1], department=values[2])
+    return subject, body, hashlib.md5((values[0] + subject + body).encode()).digest()
+
+def as_dicts(rows):
+    emails = []
+    for i, values in enumerate(rows):
+        subject, body, digest = render(values)
+        email = dict(zip(COLUMNS, values))
+        email['subject'] = subject
+        email['body'] = attach_transparent_image(body, make_image_links([digest.hex()])[0])
+        email['body_view'] = body
+        email['hash'] = digest.hex()
+        email['id'] = str(i)
+        emails.append(email)
+    return emails
+
+def as_records(rows):
+    layout = {column: i for i, column in enumerate(COLUMNS)}
+    emails = []
+    for i, values in enumerate(rows):
+        subject, body, digest = render(values)
+        emails.append(Prepared_Email(layout, values, subject, body, digest, i))
+    return emails
+
+def metadata_as_dicts(emails):
+    return [{key: email[key] for key in ('email', 'department', 'hash', 'id')} for email in emails]
+
+def metadata_as_records(emails):
+    return [Email_Metadata(email.email, email.department, email._digest, email._id) for email in emails]
+
+def measure(build, *args):
+    """Returns the memory allocated by build(*args) and still held by its result, in bytes per recipient."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(*args)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, used / RECIPIENTS
+
+def main():
+    rows = make_rows()
+    _, dict_emails = measure(as_dicts, rows)
+    records, record_emails = measure(as_records, rows)
+    _, dict_metadata = measure(metadata_as_dicts, records)
+    _, record_metadata = measure(metadata_as_records, records)
+
+    print(f"{'bytes per recipient':<22} {'dict':>10} {'record':>10} {'saved':>8}")
+    for name, dict_size, record_size in [('prepared email', dict_emails, record_emails),
+                                         ('email details', dict_metadata, record_metadata)]:
+        print(f"{name:<22} {dict_size:>10.0f} {record_size:>10.0f} {1 - record_size / dict_size:>7.0%}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Benchmarks the compiled single-pass template renderer against the previous str.replace loop.
+
+Usage (from the repository root):
+python benchmarks/bench_template.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from parser import compile_template, fill_template
+
+HEADERS = ['name', 'department', 'field1', 'field2', 'field3']
+RECIPIENT = {'name': 'Alice Smith', 'department': 'HR', 'field1': 'one', 'field2': 'two', 'field3': 'three'}
+BODY_SIZES = [1_000, 10_000, 100_000]
+PLACEHOLDER_COUNTS = [2, 10, 50]
+RECIPIENTS = 200
+
+def replace_loop(template, headers, recipient_data):
+    for header in headers:
+        template = template.replace('#' + header + '#', recipient_data[header])
+    return template
+
+def make_body(size, placeholder_count):
+    placeholders = ['#' + HEADERS[i % len(HEADERS)] + '#' for i in range(placeholder_count)]
+    filler = 'x' * max(size // (placeholder_count + 1), 1)
+    return filler + filler.join(placeholders) + filler
+
+def main():
+    print(f"{'body size':>10} {'placeholders':>13} {'replace (ms)':>13} {'compiled (ms)':>14} {'speedup':>8}")
+    for size in BODY_SIZES:
+        for placeholder_count in PLACEHOLDER_COUNTS:
+            body = make_body(size, placeholder_count)
+            compiled = compile_template(body, HEADERS)
+            assert fill_template(compiled, RECIPIENT) == replace_loop(body, HEADERS, RECIPIENT)
+
+            replace_time = min(timeit.repeat(lambda: replace_loop(body, HEADERS, RECIPIENT), number=RECIPIENTS, repeat=5))
+            compiled_time = min(timeit.repeat(lambda: fill_template(compiled, RECIPIENT), number=RECIPIENTS, repeat=5))
+            print(f"{size:>10} {placeholder_count:>13} {replace_time * 1000:>13.2f} "
+                  f"{compiled_time * 1000:>14.2f} {replace_time / compiled_time:>7.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+from collections import OrderedDict
+from email_manager import Email_Manager
+from image_link import Image_Count_Manager, Hit_Store_Backend
+from parser import Parser
+from send_journal import ABANDONED, SENDING
+from threading import Lock
+import shutil
+import uuid
+import os
+
+# Finished campaigns are evicted (least recently used first) beyond these limits.
+# Campaigns that are still sending are never evicted.
+MAX_CAMPAIGNS = 32
+MAX_CAMPAIGNS_PER_USER = 4
+
+"""
+A single upload of mail data and body by a user, and everything prepared and sent from it.
+Campaigns are isolated from each other, so several users can prepare and send emails at the same time.
+"""
+class Campaign:
+    def __init__(self, campaign_id, user_id, upload_folder, hit_store, journal=None, job_queue=None):
+        self.id = campaign_id
+        self.user_id = user_id
+        self.upload_folder = upload_folder
+        self.parser = None
+        self.journal = journal
+        self.job_queue = job_queue
+        self.email_manager = Email_Manager(journal, campaign_id, job_queue)
+        self.invalid_emails = []
+        # Emails prepared for checking view counts, served to the email table page by page
+        self.viewed_emails = []
+        self.viewed_headers = []
+        self._hit_store = hit_store
+        self._image_count_manager = None
+        self._department_positions = [] # (emails, positions of each department) of lists paged recently
+        os.makedirs(upload_folder, exist_ok=True)
+
+    """
+    Image count manager of this campaign's emails, only started once counts are first needed.
+    """
+    @property
+    def image_count_manager(self) -> Image_Count_Manager:
+        if self._image_count_manager is None:
+            self._image_count_manager = Image_Count_Manager(Hit_Store_Backend(self._hit_store))
+        return self._image_count_manager
+
+    """
+    Returns image counts of this campaign's emails that have changed since the given version.
+    """
+    def get_image_counts(self, since=0) -> dict:
+        if self._image_count_manager is None:
+            return {"version": 0, "counts": {}}
+        return self._image_count_manager.get_image_counts(since)
+
+    """
+    Returns the positions of each department's emails in a list of this campaign's emails (viewed or sent).
+    Emails of all departments prepared from a whole CSV are in mail data order, so the parser's department index
+    is used as is. Other lists (e.g. in streaming mode) are indexed once, for as long as they are paged.
+    """
+    def department_positions(self, emails) -> dict:
+        parser = self.parser
+        if parser is not None and parser.department_index is not None and len(emails) == len(parser.mail_data_df):
+            return parser.department_index
+        for indexed_emails, positions in self._department_positions:
+            if indexed_emails is emails:
+                return positions
+        positions = {}
+        for i, email in enumerate(emails):
+            positions.setdefault(email.department, []).append(i)
+        # Only the viewed and sent emails are paged, so older lists are not kept
+        self._department_positions = [(emails, positions), *self._department_positions[:1]]
+        return positions
+
+    """
+    Returns the path at which an uploaded file of this campaign is saved.
+    """
+    def upload_path(self, filename) -> str:
+        return os.path.join(self.upload_folder, os.path.basename(filename))
+
+    def is_sending(self) -> bool:
+        return self.email_manager.is_sending()
+
+    """
+    Starts sending this campaign's emails to a department, recording it in the journal.
+    Emails are only rendered as they are sent, keeping just their compact details for viewing.
+    Parameters:
+        user (User): The user object that will send the emails.
+        department (str): Department code to send to.
+    """
+    def send(self, user, department):
+        metadata = self.parser.prepare_email_metadata(department)
+        self._hit_store.register([email.hash for email in metadata])
+        emails = self.parser.iter_emails(department)
+        self.parser.update_report_counts(department)
+        self.email_manager.store_header_and_report(self.parser.headers, self.parser.prepare_report())
+        if self.journal and not self.email_manager.has_ran:
+            self.journal.start_campaign(self.id, self.user_id, {
+                "mail_data_path": self.parser.mail_data_path,
+                "mail_body_path": self.parser.mail_body_path,
+                "chunk_size": self.parser.chunk_size,
+                "department": department,
+                "headers": self.parser.headers,
+                "report": self.email_manager.report})
+        self.email_manager.send_emails(user, emails, metadata)
+
+    """
+    Continues sending this campaign from the first email without a result in the journal.
+    Parameters:
+        user (User): The user object that will send the emails.
+        details (dict): Details recorded in the journal when the campaign started sending.
+    """
+    def resume(self, user, details):
+        department = details["department"]
+        results = self.journal.get_results(self.id)
+        metadata = self.parser.prepare_email_metadata(department)
+        self._hit_store.register([email.hash for email in metadata])
+        emails = self.parser.iter_emails(department, first_id=len(results))
+        self.email_manager.store_header_and_report(details["headers"], details["report"])
+        self.email_manager.send_emails(user, emails, metadata, results)
+
+    """
+    Releases everything held by this campaign, including its uploaded files, journal entries and queued jobs.
+    """
+    def close(self):
+        if self._image_count_manager is not None:
+            self._image_count_manager.close()
+        if self.journal:
+            self.journal.forget(self.id)
+        if self.job_queue:
+            self.job_queue.forget(self.id)
+        shutil.rmtree(self.upload_folder, ignore_errors=True)
+
+"""
+Keeps the campaigns of every user, keyed by user id and campaign id.
+Memory stays bounded by evicting finished campaigns, least recently used first.
+
+Campaigns that were still sending when the journal was last open are restored on creation,
+and continue sending once resume() is called with their user. Several processes can share the journal,
+and each campaign is only resumed by the process that claims it in the journal.
+"""
+class Campaign_Registry:
+    def __init__(self, upload_folder, hit_store, journal=None, job_queue=None, max_campaigns=MAX_CAMPAIGNS,
+                 max_campaigns_per_user=MAX_CAMPAIGNS_PER_USER):
+        self.upload_folder = upload_folder
+        self.hit_store = hit_store
+        self.journal = journal
+        self.job_queue = job_queue
+        self.max_campaigns = max_campaigns
+        self.max_campaigns_per_user = max_campaigns_per_user
+        self._campaigns = OrderedDict() # (user id, campaign id) -> campaign, least recently used first
+        self._to_resume = {} # (user id, campaign id) -> journal details of restored campaigns not resumed yet
+        self._lock = Lock()
+        if journal:
+            self._restore()
+
+    """
+    Restores the campaigns that were still sending, parsing their uploaded files again.
+    Campaigns whose files can no longer be parsed are abandoned.
+    """
+    def _restore(self):
+        for campaign_id, user_id, details in self.journal.unfinished_campaigns():
+            campaign = Campaign(campaign_id, user_id, os.path.join(self.upload_folder, campaign_id),
+                                self.hit_store, self.journal, self.job_queue)
+            try:
+                campaign.parser = Parser(details["mail_data_path"], details["mail_body_path"], details["chunk_size"])
+            except Exception as e:
+                print(f"Campaign {campaign_id} could not be resumed:", e)
+                self.journal.finish_campaign(campaign_id, ABANDONED)
+                continue
+            self._campaigns[(user_id, campaign_id)] = campaign
+            self._to_resume[(user_id, campaign_id)] = details
+
+    """
+    Returns the ids of users with restored campaigns that have not been resumed yet.
+    """
+    def users_to_resume(self) -> set[str]:
+        with self._lock:
+            return {user_id for user_id, _ in self._to_resume}
+
+    """
+    Continues sending the user's restored campaigns, if any.
+    Campaigns claimed by another running process are tried again on the next call,
+    and forgotten once they have stopped sending.
+    Parameters:
+        user (User): The user object that will send the emails.
+    """
+    def resume(self, user):
+        with self._lock:
+            if not self._to_resume:
+                return
+            keys = [key for key in self._to_resume if key[0] == user.get_id()]
+            to_resume = []
+            for key in keys:
+                if self.journal.claim_campaign(key[1]):
+                    to_resume.append((self._campaigns[key], self._to_resume.pop(key)))
+                elif self.journal.campaign_state(key[1]) != SENDING:
+                    del self._to_resume[key]
+        for campaign, details in to_resume:
+            campaign.resume(user, details)
+
+    """
+    Creates a new campaign for the user, evicting finished campaigns if there are too many.
+    Parameters:
+        user_id (str): Id of the user creating the campaign.
+    Returns: (Campaign): The new campaign.
+    """
+    def create(self, user_id) -> Campaign:
+        campaign_id = uuid.uuid4().hex
+        campaign = Campaign(campaign_id, user_id, os.path.join(self.upload_folder, campaign_id),
+                            self.hit_store, self.journal, self.job_queue)
+        with self._lock:
+            self._campaigns[(user_id, campaign_id)] = campaign
+            evicted = self._evict(user_id, (user_id, campaign_id))
+        for old_campaign in evicted:
+            old_campaign.close()
+        return campaign
+
+    """
+    Returns the user's campaign with the given id, or None if there is no such campaign.
+    Users can only access their own campaigns.
+    """
+    def get(self, user_id, campaign_id) -> Campaign:
+        with self._lock:
+            campaign = self._campaigns.get((user_id, campaign_id))
+            if campaign is not None:
+                self._campaigns.move_to_end((user_id, campaign_id))
+            return campaign
+
+    """
+    Returns all campaigns of the user, least recently used first.
+    """
+    def user_campaigns(self, user_id) -> list[Campaign]:
+        with self._lock:
+            return [campaign for (owner, _), campaign in self._campaigns.items() if owner == user_id]
+
+    """
+    Removes least recently used finished campaigns beyond the limits, except for the given one.
+    Must be called with the lock held.
+    Returns: (list[Campaign]): The removed campaigns, to be closed outside of the lock.
+    """
+    def _evict(self, user_id, keep) -> list[Campaign]:
+        user_count = sum(owner == user_id for owner, _ in self._campaigns)
+        evicted = []
+        for key, campaign in list(self._campaigns.items()):
+            over_total = len(self._campaigns) > self.max_campaigns
+            over_user = user_count > self.max_campaigns_per_user
+            if not (over_total or over_user):
+                break
+            if key == keep or key in self._to_resume or campaign.is_sending() or not (over_total or key[0] == user_id):
+                continue
+            del self._campaigns[key]
+            evicted.append(campaign)
+            if key[0] == user_id:
+                user_count -= 1
+        return evicted
@@ -1,61 +1,309 @@
+from concurrent.futures import ThreadPoolExecutor
 from flask import flash
-from threading import Thread, Event
+from itertools import islice
+from prepared_email import Email_Metadata
+from queue import Queue, Full
+from rate_limiter import get_rate_limiter
+from retry_scheduler import Retry_Scheduler, Send_Error
+from send_journal import FINISHED, CANCELLED
+from threading import Thread, Event, Condition
 import time
 
-# Note: Need to update these values in upload.html as well
-INTERVAL = 62   
-EMAILS_PER_INTERVAL = 20
+# Emails allowed by the rate limiter at the same time are sent concurrently by up to this many threads
+SEND_WORKERS = 8
+# Emails are crafted and serialized by a background thread, at most this many ahead of sending
+PREPARE_AHEAD = 200
+# Marks the end of prepared emails
+_DONE = object()
+# When sending through a job queue, prepared emails are enqueued this many at a time,
+# and the queue is checked for new results every QUEUE_POLL_INTERVAL seconds once all are enqueued
+ENQUEUE_BATCH = 500
+QUEUE_POLL_INTERVAL = 1
+# Result of emails that were waiting to be retried when sending was cancelled
+CANCELLED_RETRY = "Error: Cancelled while waiting to retry"
 
 """
 Manages email scheduling.
-Emails are sent at the specified rate limit per interval.
+Emails are sent within the rate limit of the user's account.
 Stores details regarding email being sent.
+If given a journal, the result of each email is also recorded in it, so that sending can be resumed after a restart.
+If given a job queue, emails of users that can be sent from outside their requests are only prepared and enqueued,
+to be sent by standalone workers (see worker.py), and their results are collected from the queue.
+Emails failing with a transient error (e.g. throttling or a dropped connection) are retried with backoff,
+and kept as dead letters if they still fail after all attempts, so that they can be exported or sent again.
 """
 class Email_Manager:
-    def __init__(self):
+    def __init__(self, journal=None, campaign_id=None, job_queue=None):
+        self.journal = journal
+        self.campaign_id = campaign_id
+        self.job_queue = job_queue
         self.user = None
-        self.emails = []
+        self.rate_limiter = None
+        self.emails = [] # Compact details (email, department, hash and id) of each email, for viewing.
+        self._email_source = []
+        self._source_error = None # Error that stopped emails from being prepared, if any
         self.has_ran = False
         self._thread = None
         self._cancel = Event()
         self.results = [] # Free to view while sending emails.
+        self._held = {} # Results of emails sent ahead of an earlier email waiting to be retried, by email id
+        self.retry_scheduler = Retry_Scheduler()
+        self._results_changed = Condition()
+        self._finished = True
         self.report = None
         self.headers = None
 
     """
     Send all specified emails.
-    EMAILS_PER_INTERVAL number of emails are sent every INTERVAL seconds.
+    Emails are sent as fast as the rate limiter of the user's account allows.
+    Emails allowed at the same time are sent concurrently, and their results are stored in email order.
 
     This function should not be called by the user directly. Use .send_emails() instead.
     This function can only be ran a single time for every Email_Scheduler instance.
     """
     def _send_emails(self):
-        email_sent_count = 0
-        start_time = time.time()
-
-        for email in self.emails:
-            if (email_sent_count == EMAILS_PER_INTERVAL):
-                time_spent = time.time() - start_time
-                self._cancel.wait(INTERVAL - time_spent)
-                email_sent_count = 0
-                start_time = time.time()
+        try:
+            if self._uses_job_queue():
+                self._enqueue_all_emails()
+            else:
+                self._send_all_emails()
+        finally:
+            self._email_source = []
+            if self.journal:
+                self.journal.finish_campaign(self.campaign_id, CANCELLED if self._cancel.is_set() else FINISHED)
+            with self._results_changed:
+                self._finished = True
+                self._results_changed.notify_all()
+
+    """
+    Returns whether emails are sent by standalone workers through the job queue, instead of by this process.
+    """
+    def _uses_job_queue(self):
+        return self.job_queue is not None and self.user.sends_outside_requests
+
+    """
+    Crafts and serializes all emails in order, ahead of sending them.
+    Each email is put in the queue as (prepared email, None), or (None, error message) if it could not be prepared.
+    Runs on a background thread until all emails are prepared, or stop is set. The end is always marked, even if
+    the emails themselves cannot be read (e.g. the mail data file is gone), in which case the error is kept for
+    the remaining emails.
+    """
+    def _prepare_messages(self, prepared_queue, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    prepared_queue.put(item, timeout=1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        try:
+            for email in self._email_source:
+                try:
+                    item = (self.user.prepare_message(email['email'], email['subject'], email['body']), None)
+                except Exception as err:
+                    item = (None, "Error: " + str(err))
+                if not put(item):
+                    return
+        except Exception as err:
+            self._source_error = "Error: Email could not be prepared: " + str(err)
+        finally:
+            put(_DONE)
+
+    """
+    Stores the error that stopped emails from being prepared as the result of every email without a result.
+    """
+    def _fail_unprepared(self):
+        if self._source_error is None or self._cancel.is_set():
+            return
+        missing = len(self.emails) - len(self.results)
+        if missing > 0:
+            self._add_results([self._source_error] * missing)
+
+    """
+    Sends a batch of prepared emails in a single call, keeping errors from preparing emails in place.
+    Parameters:
+        batch (list[tuple]): (email id, prepared email, error, number of attempts) of each email.
+    Returns: (list[str]): Result of each email, in the same order.
+    """
+    def _send_batch(self, batch):
+        results = [error for _, _, error, _ in batch]
+        to_send = [i for i, (_, _, error, _) in enumerate(batch) if error is None]
+        if to_send:
+            started = time.monotonic()
+            try:
+                sent_results = self.user.send_prepared_batch([batch[i][1] for i in to_send])
+            except Exception as err:
+                sent_results = [Send_Error("Error: " + str(err), transient=isinstance(err, OSError))] * len(to_send)
+            # Throttling replies and latency adapt the rate of sending
+            self.rate_limiter.feedback(sent_results, time.monotonic() - started)
+            for i, result in zip(to_send, sent_results):
+                results[i] = result
+        return results
+
+    """
+    Starts preparing emails on a background thread.
+    Returns: (iterator, threading.Event): Prepared emails as (prepared email, error) in order, and an event to stop preparing.
+    """
+    def _start_preparing(self):
+        prepared_queue = Queue(maxsize=PREPARE_AHEAD)
+        stop = Event()
+        Thread(target=self._prepare_messages, args=(prepared_queue, stop), daemon=True).start()
+        return iter(prepared_queue.get, _DONE), stop
+
+    def _send_all_emails(self):
+        # Crafting and serializing emails is kept out of the rate limited loop below
+        prepared, stop = self._start_preparing()
+        first_id = len(self.results)
+        try:
+            self._send_items(((first_id + i, message, error, 0) for i, (message, error) in enumerate(prepared)),
+                             self._add_result)
+        finally:
+            stop.set()
+            # Emails still waiting to be retried are given up on, so that the results after them can be stored
+            self.retry_scheduler.clear()
+            self._release_held(CANCELLED_RETRY)
+            self._fail_unprepared()
+
+    """
+    Sends emails within the rate limit, retrying those that fail with a transient error once their retry is due.
+    Retries are sent ahead of new emails, and count towards the rate limit like any other email.
+    Parameters:
+        items (iterator[tuple]): (email id, prepared email, error, number of attempts) of each email to send.
+        on_result (function): Called with the email id and final result of each email.
+    """
+    def _send_items(self, items, on_result):
+        pending = []
+        # Users that can send several emails per request are given up to batch_size emails per thread
+        batch_size = self.user.batch_size
+        capacity = SEND_WORKERS * batch_size
+        exhausted = False
+        with ThreadPoolExecutor(max_workers=SEND_WORKERS) as executor:
+            while not self._cancel.is_set():
+                pending = self.retry_scheduler.pop_due(capacity - len(pending)) + pending
+                if not exhausted:
+                    new_items = list(islice(items, max(capacity - len(pending), 0)))
+                    exhausted = len(new_items) < capacity - len(pending)
+                    pending += new_items
+                if not pending:
+                    next_due_in = self.retry_scheduler.next_due_in()
+                    if next_due_in is None:
+                        break
+                    self._cancel.wait(next_due_in)
+                    continue
+                allowed = self.rate_limiter.acquire(len(pending), self._cancel)
+                if self._cancel.is_set():
+                    break
+
+                batch, pending = pending[:allowed], pending[allowed:]
+                chunks = [batch[i:i + batch_size] for i in range(0, len(batch), batch_size)]
+                futures = [executor.submit(self._send_batch, chunk) for chunk in chunks]
+                for chunk, future in zip(chunks, futures):
+                    for item, result in zip(chunk, future.result()):
+                        if self.retry_scheduler.handle_result(item, result):
+                            on_result(item[0], result)
+
+    """
+    Enqueues all prepared emails in the job queue, and collects their results in order as workers send them.
+    Rate limits are applied by the workers.
+    """
+    def _enqueue_all_emails(self):
+        prepared, stop = self._start_preparing()
+        user_id = self.user.get_id()
+        next_id = len(self.results)
+        enqueued_all = False
+        try:
+            while not self._cancel.is_set():
+                if not enqueued_all:
+                    batch = list(islice(prepared, ENQUEUE_BATCH))
+                    self.job_queue.enqueue(self.campaign_id, user_id,
+                                           [(next_id + i, message, error) for i, (message, error) in enumerate(batch)])
+                    next_id += len(batch)
+                    enqueued_all = len(batch) < ENQUEUE_BATCH
+
+                results = self.job_queue.get_results(self.campaign_id, len(self.results))
+                if results:
+                    self._add_results(results)
+                if enqueued_all:
+                    if len(self.results) >= next_id:
+                        break
+                    self._cancel.wait(QUEUE_POLL_INTERVAL)
             if self._cancel.is_set():
-                break
-            
-            recipient = email['email']
-            subject = email['subject']
-            body = email['body']
+                self.job_queue.cancel(self.campaign_id)
+            self._fail_unprepared()
+        finally:
+            stop.set()
 
-            self.results.append(self.user.send_message(recipient, subject, body))
-            email_sent_count += 1
+    """
+    Stores results of sent emails, and wakes up anything waiting for new results.
+    """
+    def _add_results(self, results):
+        with self._results_changed:
+            if self.journal:
+                self.journal.record_results(self.campaign_id, len(self.results), results)
+            self.results.extend(results)
+            self._results_changed.notify_all()
+
+    """
+    Stores the final result of an email, which may be sent out of order because of retries.
+    Results are held back until the results of all emails before them are stored, so results stay in email order.
+    """
+    def _add_result(self, email_id, result):
+        with self._results_changed:
+            self._held[email_id] = result
+            next_id = len(self.results)
+            results = []
+            while next_id + len(results) in self._held:
+                results.append(self._held.pop(next_id + len(results)))
+            if results:
+                self._add_results(results)
+
+    """
+    Stores all results held back, using the given result for the emails before them that have no result.
+    """
+    def _release_held(self, missing_result):
+        with self._results_changed:
+            if not self._held:
+                return
+            next_id = len(self.results)
+            results = [self._held.get(email_id, missing_result) for email_id in range(next_id, max(self._held) + 1)]
+            self._held = {}
+            self._add_results(results)
+
+    """
+    Replaces the result of an email that was already stored, e.g. once a dead letter is sent again.
+    """
+    def _update_result(self, email_id, result):
+        with self._results_changed:
+            if self.journal:
+                self.journal.record_results(self.campaign_id, email_id, [result])
+            self.results[email_id] = result
+            self._results_changed.notify_all()
+
+    """
+    Returns results after the given position, waiting for new ones while emails are being sent.
+    Parameters:
+        cursor (int): Number of results already seen.
+        timeout (float): Maximum number of seconds to wait for new results.
+    Returns:
+        (list[str], bool): New results, and whether sending has finished with no results left after them.
+    """
+    def wait_for_results(self, cursor, timeout):
+        with self._results_changed:
+            self._results_changed.wait_for(lambda: len(self.results) > cursor or self._finished, timeout)
+            return self.results[cursor:], self._finished
 
     """
     Start sending emails at specified rate limit.
     Parameters:
         user (User): The user object that will send the emails.
-        emails (list[dict]): The emails to be sent.
+        emails (iterable[Prepared_Email]): The emails to be sent. May be a lazy iterator, which is only consumed while sending.
+        metadata (list[Email_Metadata]): Compact details (email, department, hash and id) of each email.
+                               Derived from emails if not given, which requires emails to be a list.
+        results (list[str]): Results of the first emails, already sent before a restart. emails must start after them.
     """
-    def send_emails(self, user, emails):
+    def send_emails(self, user, emails, metadata=None, results=None):
         if self.has_ran:
             if self._thread.is_alive():
                 flash("Note: The current batch of emails are still being sent. It was not sent again.")
@@ -64,10 +312,19 @@ class Email_Manager:
             return
         
         self.user = user
-        self.emails = emails
+        self.rate_limiter = get_rate_limiter(user, self.job_queue.path if self.job_queue else None)
+        if metadata is None:
+            metadata = [Email_Metadata.from_mapping(email) for email in emails]
+        self.emails = metadata
+        self._email_source = emails
+        self._source_error = None
         self.has_ran = True
         self._cancel.clear()
-        self.results.clear()
+        self.retry_scheduler = Retry_Scheduler()
+        with self._results_changed:
+            self.results = list(results) if results else []
+            self._held = {}
+            self._finished = False
         self._thread = Thread(target=self._send_emails)
         self._thread.start()
 
@@ -102,6 +359,77 @@ class Email_Manager:
         flash("Successfully cancelled.")
         self._cancel.set()
 
+    """
+    Returns the emails of the current batch that still failed with a transient error after all attempts.
+    Returns: (list[dict]): Id, email, error and number of attempts of each dead letter.
+    """
+    def dead_letters(self):
+        if self.user is None:
+            return []
+        if self._uses_job_queue():
+            letters = self.job_queue.dead_letters(self.campaign_id)
+        else:
+            letters = sorted((email_id, error, attempts)
+                             for email_id, _, error, attempts in list(self.retry_scheduler.dead_letters))
+        return [{"id": email_id, "email": self.emails[email_id].email, "error": error, "attempts": attempts}
+                for email_id, error, attempts in letters]
+
+    """
+    Sends the dead letters of the current batch again, with all their attempts, replacing their results as they are sent.
+    This is disallowed while the current batch is still being sent.
+    """
+    def redrive_dead_letters(self):
+        if not self.has_ran:
+            flash("There are no sent emails to retry.")
+            return
+        if self.is_sending():
+            flash("Note: The current batch of emails are still being sent. Please wait until it has finished sending.")
+            return
+
+        if self._uses_job_queue():
+            email_ids = self.job_queue.redrive(self.campaign_id)
+            thread = Thread(target=self._collect_redriven, args=(email_ids,))
+        else:
+            items = [(email_id, prepared, None, 0)
+                     for email_id, prepared, _, _ in self.retry_scheduler.take_dead_letters()]
+            email_ids = [item[0] for item in items]
+            thread = Thread(target=self._redrive, args=(items,))
+        if not email_ids:
+            flash("There are no failed emails to retry.")
+            return
+        flash(f"Retrying {len(email_ids)} failed emails.")
+        self._cancel.clear()
+        self._thread = thread
+        self._thread.start()
+
+    def _redrive(self, items):
+        try:
+            self._send_items(iter(items), self._update_result)
+        finally:
+            self.retry_scheduler.clear()
+
+    """
+    Collects the results of dead letters sent again by workers through the job queue.
+    """
+    def _collect_redriven(self, email_ids):
+        remaining = set(email_ids)
+        while remaining and not self._cancel.is_set():
+            for email_id, result in self.job_queue.get_final_results(self.campaign_id, remaining):
+                self._update_result(email_id, result)
+                remaining.discard(email_id)
+            if remaining:
+                self._cancel.wait(QUEUE_POLL_INTERVAL)
+        if self._cancel.is_set():
+            self.job_queue.cancel(self.campaign_id)
+
+    """
+    Returns the number of emails waiting to be retried, and of dead letters.
+    """
+    def retry_state(self):
+        if self.user is not None and self._uses_job_queue():
+            return self.job_queue.retry_state(self.campaign_id)
+        return self.retry_scheduler.state()
+
     """
     Store headers and report for currently sending emails.
     Used to coordinate between currently sending emails their relevant details
@@ -0,0 +1,100 @@
+from threading import Thread, Lock, Event
+import sqlite3
+import atexit
+
+HIT_STORE_PATH = "hits.db"
+# Hits are buffered in memory and written in a single transaction every FLUSH_INTERVAL seconds,
+# or as soon as FLUSH_THRESHOLD unique ids have pending hits
+FLUSH_INTERVAL = 2
+FLUSH_THRESHOLD = 1000
+# Stays below SQLite's limit on the number of parameters of a single query
+LOOKUP_CHUNK_SIZE = 500
+
+"""
+Stores the number of times each tracking image has been loaded, keyed by unique id.
+Counts are persisted in SQLite (in WAL mode, so reads do not block writes) and survive restarts.
+Hits are buffered in memory and flushed in batches, so bursts of image loads do not wait on disk I/O.
+Only ids registered when their emails are sent are counted, so requests for made up ids cannot grow the database.
+"""
+class Hit_Store:
+    def __init__(self, path=HIT_STORE_PATH, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._pending_lock = Lock()
+        self._db_lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS hits (unique_id TEXT PRIMARY KEY, hits INTEGER NOT NULL) WITHOUT ROWID")
+        self._db.commit()
+
+        self._flush_now = Event()
+        self._closed = Event()
+        self._thread = Thread(target=self._flush_periodically, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _flush_periodically(self):
+        while not self._closed.is_set():
+            self._flush_now.wait(self.flush_interval)
+            self._flush_now.clear()
+            self.flush()
+
+    """
+    Registers the unique ids of emails about to be sent, so that loads of their tracking images are counted.
+    Ids registered before keep their counts.
+    """
+    def register(self, unique_id_list):
+        with self._db_lock, self._db:
+            self._db.executemany("INSERT OR IGNORE INTO hits (unique_id, hits) VALUES (?, 0)",
+                                 ((unique_id,) for unique_id in unique_id_list))
+
+    """
+    Records a single load of the tracking image with the given unique id.
+    Loads of ids that were never registered are dropped when flushed.
+    """
+    def record(self, unique_id):
+        with self._pending_lock:
+            self._pending[unique_id] = self._pending.get(unique_id, 0) + 1
+            if len(self._pending) >= FLUSH_THRESHOLD:
+                self._flush_now.set()
+
+    """
+    Writes all buffered hits to the database in a single transaction.
+    """
+    def flush(self):
+        # Holding the database lock throughout ensures that get_counts() never misses or double counts a hit
+        with self._db_lock, self._db:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+            self._db.executemany("UPDATE hits SET hits = hits + ? WHERE unique_id = ?",
+                                 ((hits, unique_id) for unique_id, hits in pending.items()))
+
+    """
+    Returns the number of loads of each tracking image, in the same order as unique_id_list.
+    Includes hits that have not been flushed yet.
+    Parameters:
+        unique_id_list (list[str]): List of unique ids.
+    """
+    def get_counts(self, unique_id_list) -> list[int]:
+        counts = {}
+        with self._db_lock:
+            for i in range(0, len(unique_id_list), LOOKUP_CHUNK_SIZE):
+                chunk = unique_id_list[i:i + LOOKUP_CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                counts.update(self._db.execute(f"SELECT unique_id, hits FROM hits WHERE unique_id IN ({placeholders})",
+                                               chunk))
+            with self._pending_lock:
+                return [counts.get(unique_id, 0) + self._pending.get(unique_id, 0) for unique_id in unique_id_list]
+
+    """
+    Flushes buffered hits and stops the background flushing.
+    """
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._flush_now.set()
+        self._thread.join()
+        self.flush()
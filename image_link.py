@@ -1,139 +1,214 @@
-from datetime import timedelta, date
+from bisect import bisect_right
 from flask import flash
+from threading import Thread, Lock, Event
 import aiohttp
 import asyncio
+import random
+import time
+import os
 
 # Don't overwhelm the slow server
 REQUEST_LIMIT = 25
-# Unlikely to check email after 90 days
-EXPIRY_DATE = (date.today() + timedelta(days=90)).strftime("%m/%d/%Y")
+# Failed count lookups are retried with exponential backoff and jitter: BACKOFF_BASE * 2^attempt + [0, BACKOFF_BASE) seconds
+MAX_ATTEMPTS = 3
+BACKOFF_BASE = 0.5
+# Url at which recipients' mail clients can reach this application to load tracking images
+TRACKING_BASE_URL = os.environ.get("TRACKING_BASE_URL", "http://127.0.0.1:5000").rstrip("/")
+# Cached counts are refreshed in the background every REFRESH_INTERVAL seconds,
+# for as long as they have been requested within the last IDLE_TIMEOUT seconds
+REFRESH_INTERVAL = 10
+IDLE_TIMEOUT = 60
 
 """
-A coroutine to generate a single image link.
-"""
-async def _make_image_link(session, unique_id) -> str:
-    params = {"url": "https://upload.wikimedia.org/wikipedia/commons/c/ca/1x1.png",
-              "type": "json",
-              "private": "1",
-              "expire": EXPIRY_DATE,
-              # Ensures the input is a string, as there is no type checking for unique_id
-              "custom": str(unique_id)}
-    
-    for i in range(3): # Retries
-        if i > 0:
-            asyncio.sleep(1)
-        async with session.get("https://ulvis.net/API/write/get", params=params) as redirect:
-            if not redirect.ok:
-                print("make_image_links Error:", redirect.status)
-                continue
-                
-            try:
-                parsed_redirect = await redirect.json()
-            except aiohttp.ContentTypeError:
-                print("make_image_links Error:", redirect.status)
-                continue
+Generates unique tracking image links for each unique id.
+Links point to this application's own tracking endpoint, so no requests are made.
 
-            if "data" not in parsed_redirect or "url" not in parsed_redirect["data"]:
-                error_msg = f"make_image_links Error for {unique_id}."
-                # Check if error message can be found
-                if "data" in parsed_redirect and "status" in parsed_redirect["data"]:
-                    error_msg += f" {parsed_redirect['data']['status']}."
-                print(error_msg)
-                continue
+Parameters:
+unique_id_list (list[str]): List of unique ids.
+base_url (str): Url at which recipients can reach this application.
 
-            return parsed_redirect["data"]["url"]
+Returns:
+list[str]: List of unique links.
+"""
+def make_image_links(unique_id_list, base_url=TRACKING_BASE_URL) -> list[str]:
+    return [f"{base_url}/t/{unique_id}.png" for unique_id in unique_id_list]
 
-    # flash("Ulvis server is down... View stats may not function properly.")
-    return "https://ulvis.net/" + str(unique_id)
 
 """
-Asynchronously generates unique links for each unique id.
-Usage: asyncio.run(make_image_links(unique_id_list))
+Raised by a count backend when a lookup failed and may succeed if retried.
+"""
+class Count_Lookup_Error(Exception):
+    pass
 
-Parameters:
-unique_id_list (list[str]): List of unique ids.
+"""
+Backend that image counts are looked up from.
+Subclasses set how many unique ids can be looked up per request (batch_size),
+and how many requests may be in flight at once (concurrency).
+"""
+class Count_Backend:
+    batch_size = 1
+    concurrency = 1
+
+    async def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    """
+    Looks up the image count of at most batch_size unique ids.
+    Raises Count_Lookup_Error if the lookup should be retried.
+    This base backend has no counts, so every id is reported as never found.
+
+    Returns:
+    list: Image count of each unique id ("error" for an id that will never be found).
+    """
+    async def get_counts(self, unique_id_list) -> list:
+        return ["error"] * len(unique_id_list)
 
-Returns:
-list[str]: List of unique links.
 """
-async def make_image_links(unique_id_list) -> list[str]:
-    conn = aiohttp.TCPConnector(limit=REQUEST_LIMIT)
-    async with aiohttp.ClientSession(connector = conn) as session:
-        coroutines = [_make_image_link(session, unique_id) for unique_id in unique_id_list]
-        return await asyncio.gather(*coroutines)
+Looks up image counts from a Hit_Store, recorded by this application's tracking endpoint.
+"""
+class Hit_Store_Backend(Count_Backend):
+    batch_size = 5000
+    concurrency = 1
+
+    def __init__(self, hit_store):
+        self.hit_store = hit_store
 
+    async def get_counts(self, unique_id_list) -> list:
+        return await asyncio.to_thread(self.hit_store.get_counts, unique_id_list)
 
 """
-Manages obtaining image counts.
-Unique ids are used to identify and retrieve links for getting image counts.
+Looks up image counts of ulvis.net links, which only allows one id per request.
 """
-class Image_Count_Manager:
+class Ulvis_Backend(Count_Backend):
+    batch_size = 1
+    concurrency = REQUEST_LIMIT
+
     def __init__(self):
-        self.unique_id_list = []
         self.session = None
-        # Manually manage an event loop for this instance, to allow session (aiohttp.ClientSession)
-        # to be persistent across each call of get_image_counts(), making it much more responsive.
-        self.event_loop = asyncio.new_event_loop()
-        self.event_loop.run_until_complete(self._create_session())
 
-    def __del__(self):
+    async def open(self):
+        conn = aiohttp.TCPConnector(limit=REQUEST_LIMIT)
+        self.session = aiohttp.ClientSession(connector = conn)
+
+    def close(self):
         # Connector has to be manually closed since session.close() is a coroutine, and it may not be able
         # to run as event loops could be closed when exiting the program. The connector is then
         # manually detached to prevent false error messages of connector not being closed.
         self.session.connector.close()
         self.session.detach()
-        self.event_loop.close()
 
-    async def _create_session(self):
-        conn = aiohttp.TCPConnector(limit=REQUEST_LIMIT)
-        self.session = aiohttp.ClientSession(connector = conn)
-
-    """
-    Updates the unique ids which are used to obtain image view counts.
-    """
-    def update_unique_id_list(self, unique_id_list):
-        self.unique_id_list = unique_id_list
+    async def get_counts(self, unique_id_list) -> list:
+        return [await self._get_image_count(unique_id) for unique_id in unique_id_list]
 
     """
     A coroutine to obtain a single image count.
     """
-    async def _get_image_count(self, unique_id) -> int:
+    async def _get_image_count(self, unique_id):
         if unique_id == None:
             return "error"
         params = {"type": "json",
                 # Ensures the input is a string, as there is no type checking for unique_id
                 "id": str(unique_id)}
 
-        for i in range(3): # Retries
-            if i > 0:
-                asyncio.sleep(1)
-            async with self.session.get("https://ulvis.net/API/read/get", params=params) as redirect:
-                if not redirect.ok:
-                    print("Image_Link Error:", redirect.status)
-                    continue
+        async with self.session.get("https://ulvis.net/API/read/get", params=params) as redirect:
+            if not redirect.ok:
+                raise Count_Lookup_Error(f"Image_Link Error: {redirect.status}")
 
-                try:
-                    parsed_redirect = await redirect.json()
-                except aiohttp.ContentTypeError:
-                    print("Image_Link Error:", redirect.status)
-                    continue
+            try:
+                parsed_redirect = await redirect.json()
+            except aiohttp.ContentTypeError:
+                raise Count_Lookup_Error(f"Image_Link Error: {redirect.status}")
+
+            if "data" not in parsed_redirect or "hits" not in parsed_redirect["data"]:
+                error_msg = f"Image_Link Error for {unique_id}."
+                # Check if error message can be found
+                if "error" in parsed_redirect and "msg" in parsed_redirect["error"]:
+                    error_msg += f" {parsed_redirect['error']['msg']}."
+                raise Count_Lookup_Error(error_msg)
+
+            return parsed_redirect["data"]["hits"]
+
+
+"""
+Manages obtaining image counts.
+Unique ids are used to identify and retrieve links for getting image counts.
+Counts are looked up from the given backend, e.g. a Hit_Store_Backend for tracking images served by
+this application, or from ulvis.net by default (tracking images of emails sent with ulvis.net links).
+
+Counts are refreshed by a background thread into a shared cache, so the number of requests made
+does not depend on how many pages are polling. Each change to the cache is given a version number,
+so that pollers only receive counts that have changed since the last version they have seen.
+"""
+class Image_Count_Manager:
+    def __init__(self, backend=None, refresh_interval=REFRESH_INTERVAL):
+        self.unique_id_list = []
+        self.backend = backend if backend else Ulvis_Backend()
+        self.refresh_interval = refresh_interval
+        self.version = 0
+        self.counts = []
+        self._change_log = [] # (version, index) of each change to counts, in version order
+        self._lock = Lock()
+        self._last_requested = 0
+        self._refresh_now = Event()
+        self._closed = Event()
+        # Manually manage an event loop for this instance, to allow the backend's session (e.g. aiohttp.ClientSession)
+        # to be persistent across each refresh, making it much more responsive.
+        self.event_loop = asyncio.new_event_loop()
+        self.event_loop.run_until_complete(self.backend.open())
+        self._semaphore = None
+        self._refresher = Thread(target=self._refresh_periodically, daemon=True)
+        self._refresher.start()
+
+    def __del__(self):
+        self.close()
+
+    """
+    Stops refreshing counts in the background, and closes the backend.
+    """
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._refresh_now.set()
+        self._refresher.join()
+        self.backend.close()
+        self.event_loop.close()
 
-                if "data" not in parsed_redirect or "hits" not in parsed_redirect["data"]:
-                    error_msg = f"Image_Link Error for {unique_id}."
-                    # Check if error message can be found
-                    if "error" in parsed_redirect and "msg" in parsed_redirect["error"]:
-                        error_msg += f" {parsed_redirect['error']['msg']}."
-                    print(error_msg)
-                    continue
+    """
+    Updates the unique ids which are used to obtain image view counts.
+    """
+    def update_unique_id_list(self, unique_id_list):
+        with self._lock:
+            self.unique_id_list = unique_id_list
+            self.version += 1
+            self.counts = [None] * len(unique_id_list)
+            self._change_log = [(self.version, i) for i in range(len(unique_id_list))]
+            self._last_requested = time.monotonic()
+        self._refresh_now.set()
 
-                return parsed_redirect["data"]["hits"]
+    """
+    A coroutine to obtain the image counts of one batch of unique ids from the backend.
+    Failed lookups are retried with exponential backoff and jitter, up to MAX_ATTEMPTS attempts.
+    """
+    async def _get_batch_counts(self, unique_id_list) -> list:
+        async with self._semaphore:
+            for attempt in range(MAX_ATTEMPTS):
+                if attempt > 0:
+                    await asyncio.sleep(BACKOFF_BASE * 2 ** (attempt - 1) + random.uniform(0, BACKOFF_BASE))
+                try:
+                    return await self.backend.get_counts(unique_id_list)
+                except (Count_Lookup_Error, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    print("Image_Link Error:", e)
 
         # flash("View stats failed to load for an email.")
-        return "error"
+        return ["error"] * len(unique_id_list)
 
     """
-    Asynchronously gets image download count for each unique id.
-    Usage: asyncio.run(_get_image_counts(unique_id_list))
+    Asynchronously gets image download count for each unique id, in batches of the backend's batch_size
+    with at most the backend's concurrency batches in flight.
 
     Parameters:
     unique_id_list (list[str]): List of unique ids.
@@ -141,23 +216,74 @@ class Image_Count_Manager:
     Returns:
     list[str]: List of image download counts.
     """
-    async def _get_image_counts(self) -> list[str]:
-        coroutines = [self._get_image_count(unique_id) for unique_id in self.unique_id_list]
-        return await asyncio.gather(*coroutines)
+    async def _get_image_counts(self, unique_id_list) -> list[str]:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.backend.concurrency)
+        batch_size = self.backend.batch_size
+        coroutines = [self._get_batch_counts(unique_id_list[i:i + batch_size])
+                      for i in range(0, len(unique_id_list), batch_size)]
+        return [count for batch_counts in await asyncio.gather(*coroutines) for count in batch_counts]
     
     """
-    Asynchronously gets image download count for each unique id in self.unique_id_list.
+    Gets image download count for each unique id in unique_id_list.
+    Only called by the refresher thread, which owns the event loop.
     """
-    def get_image_counts(self) -> list[str]:
-        try:
-            coroutine = self._get_image_counts()
-            image_counts = self.event_loop.run_until_complete(coroutine)
-        except RuntimeError: # Previous loop still running
-            coroutine.close()
-            return []
+    def _fetch_image_counts(self, unique_id_list) -> list[str]:
+        image_counts = self.event_loop.run_until_complete(self._get_image_counts(unique_id_list))
         
         # Remove invalid ids to prevent unnecessary server spam
         for i in range(len(image_counts)):
             if image_counts[i] == "error":
-                self.unique_id_list[i] = None
+                unique_id_list[i] = None
         return image_counts
+
+    """
+    Fetches the latest image counts and records those that have changed in the cache.
+    """
+    def refresh(self):
+        unique_id_list = self.unique_id_list
+        image_counts = self._fetch_image_counts(unique_id_list)
+        with self._lock:
+            if unique_id_list is not self.unique_id_list: # Replaced while fetching
+                return
+            changed = [i for i in range(len(image_counts)) if image_counts[i] != self.counts[i]]
+            if not changed:
+                return
+            self.version += 1
+            for i in changed:
+                self.counts[i] = image_counts[i]
+                self._change_log.append((self.version, i))
+            # Drop superseded changes once the log grows well beyond the number of counts
+            if len(self._change_log) > 4 * len(self.counts):
+                latest = {i: version for version, i in self._change_log}
+                self._change_log = sorted((version, i) for i, version in latest.items())
+
+    def _refresh_periodically(self):
+        while not self._closed.is_set():
+            self._refresh_now.wait(self.refresh_interval)
+            self._refresh_now.clear()
+            if self._closed.is_set():
+                return
+            if self.unique_id_list and time.monotonic() - self._last_requested < IDLE_TIMEOUT:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print("Image_Count_Manager refresh Error:", e)
+
+    """
+    Gets cached image download counts that have changed since the given version.
+
+    Parameters:
+    since (int): Latest version already seen by the caller. 0 to get all counts.
+
+    Returns:
+    dict: Current version, and counts (index -> count) that have changed since the given version.
+    """
+    def get_image_counts(self, since=0) -> dict:
+        with self._lock:
+            if time.monotonic() - self._last_requested >= IDLE_TIMEOUT: # Cache went stale while idle
+                self._refresh_now.set()
+            self._last_requested = time.monotonic()
+            start = bisect_right(self._change_log, (since, len(self.counts)))
+            changes = {i: self.counts[i] for _, i in self._change_log[start:]}
+            return {"version": self.version, "counts": changes}
@@ -0,0 +1,263 @@
+from contextlib import contextmanager
+from itertools import zip_longest
+from threading import Lock
+import sqlite3
+import pickle
+import time
+
+JOB_QUEUE_PATH = "jobs.db"
+# Leased jobs become visible to other workers again if not completed within this many seconds,
+# e.g. because the worker leasing them has stopped
+VISIBILITY_TIMEOUT = 60
+# Waits up to this many seconds for other processes to release the database
+BUSY_TIMEOUT = 30
+
+# States of a job. Queued jobs (once their retry is due), and leased jobs whose lease has expired,
+# can be leased by any worker. Dead jobs failed with a transient error after all attempts.
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+DEAD = "dead"
+
+"""
+Queue of prepared emails shared by every process on this machine, stored in SQLite (in WAL mode).
+The application enqueues the prepared emails of a campaign, and standalone workers (see worker.py) lease,
+send and complete them. Each lease expires after a visibility timeout, so emails leased by a worker that
+stopped are sent by another worker instead. Sending is therefore at least once.
+
+Jobs are keyed by campaign id and email id, so enqueuing an email again has no effect.
+Jobs are leased in the order they were enqueued, with users taking turns, so that a large campaign of one user
+does not hold up the campaigns of others.
+Jobs failing with a transient error are queued again to be retried later, and kept as dead jobs (with their
+prepared email) once out of attempts, so that they can be sent again.
+"""
+class Job_Queue:
+    def __init__(self, path=JOB_QUEUE_PATH):
+        self.path = path
+        self._lock = Lock()
+        # Transactions are managed explicitly, so that leases are taken atomically across processes
+        self._db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS jobs (campaign_id TEXT NOT NULL, email_id INTEGER NOT NULL, "
+                         "user_id TEXT NOT NULL, prepared BLOB, state TEXT NOT NULL, worker TEXT, "
+                         "lease_until REAL, result TEXT, attempts INTEGER NOT NULL DEFAULT 0, enqueued REAL, "
+                         "PRIMARY KEY (campaign_id, email_id)) WITHOUT ROWID")
+        # Queues created before retries were added have no attempts column, and before fair leasing no enqueued column
+        columns = [column[1] for column in self._db.execute("PRAGMA table_info(jobs)")]
+        if "attempts" not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        if "enqueued" not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN enqueued REAL")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, lease_until)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_by_user ON jobs (state, user_id, enqueued)")
+
+    """
+    Runs the enclosed statements in a single write transaction, which other processes wait on.
+    """
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    """
+    Adds prepared emails of a campaign to the queue.
+    Emails that could not be prepared are added as done, with their error as result.
+    Parameters:
+        campaign_id (str): Id of the campaign.
+        user_id (str): Id of the user sending the emails.
+        jobs (list[tuple]): (email id, prepared email, error) of each email. Prepared emails must be picklable.
+    """
+    def enqueue(self, campaign_id, user_id, jobs):
+        now = time.time()
+        rows = [(campaign_id, email_id, user_id, None if error else pickle.dumps(prepared), DONE if error else QUEUED,
+                 error, now) for email_id, prepared, error in jobs]
+        with self._transaction() as db:
+            db.executemany("INSERT OR IGNORE INTO jobs (campaign_id, email_id, user_id, prepared, state, result, enqueued) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    """
+    Leases up to count visible jobs. Jobs whose lease has expired come first, then users take turns,
+    each with their jobs in the order they were enqueued.
+    Parameters:
+        worker_id (str): Unique id of the worker leasing the jobs.
+        count (int): Maximum number of jobs to lease.
+        visibility_timeout (float): Seconds until the jobs become visible to other workers again.
+        skip_users (set[str]): Ids of users whose jobs are not leased, e.g. because their rate limit is exhausted.
+    Returns: (list[tuple]): (campaign id, email id, user id, prepared email, attempts so far) of each leased job.
+    """
+    def lease(self, worker_id, count, visibility_timeout=VISIBILITY_TIMEOUT, skip_users=()) -> list[tuple]:
+        now = time.time()
+        with self._transaction() as db:
+            rows = [row for row in db.execute("SELECT campaign_id, email_id, user_id, prepared, attempts FROM jobs "
+                                              "WHERE state = ? AND lease_until < ? ORDER BY lease_until LIMIT ?",
+                                              (LEASED, now, count))
+                    if row[2] not in skip_users]
+            # Users with queued jobs, found with one index lookup per user however many jobs they have
+            user_ids = [user_id for user_id, in db.execute(
+                "WITH RECURSIVE users (user_id) AS (SELECT MIN(user_id) FROM jobs WHERE state = ? UNION ALL "
+                "SELECT (SELECT MIN(user_id) FROM jobs WHERE state = ? AND user_id > users.user_id) FROM users "
+                "WHERE users.user_id IS NOT NULL) SELECT user_id FROM users WHERE user_id IS NOT NULL", (QUEUED, QUEUED))
+                if user_id not in skip_users]
+            # Queued jobs waiting to be retried have lease_until set to when their retry is due
+            user_rows = [db.execute("SELECT campaign_id, email_id, user_id, prepared, attempts FROM jobs "
+                                    "WHERE state = ? AND user_id = ? AND IFNULL(lease_until, 0) <= ? "
+                                    "ORDER BY enqueued, campaign_id, email_id LIMIT ?",
+                                    (QUEUED, user_id, now, count - len(rows))).fetchall() for user_id in user_ids]
+            rows += [row for turn in zip_longest(*user_rows) for row in turn if row is not None]
+            rows = rows[:count]
+            db.executemany("UPDATE jobs SET state = ?, worker = ?, lease_until = ? WHERE campaign_id = ? AND email_id = ?",
+                           [(LEASED, worker_id, now + visibility_timeout, campaign_id, email_id)
+                            for campaign_id, email_id, _, _, _ in rows])
+        return [(campaign_id, email_id, user_id, pickle.loads(prepared), attempts)
+                for campaign_id, email_id, user_id, prepared, attempts in rows]
+
+    """
+    Extends the leases of jobs still held by the worker.
+    Parameters:
+        worker_id (str): Id of the worker holding the leases.
+        keys (list[tuple[str, int]]): (campaign id, email id) of each job.
+        visibility_timeout (float): Seconds from now until the jobs become visible to other workers again.
+    Returns: (set[tuple[str, int]]): Keys of the jobs whose lease was extended, i.e. that are still held.
+    """
+    def renew(self, worker_id, keys, visibility_timeout=VISIBILITY_TIMEOUT) -> set:
+        now = time.time()
+        held = set()
+        with self._transaction() as db:
+            for campaign_id, email_id in keys:
+                cursor = db.execute("UPDATE jobs SET lease_until = ? WHERE campaign_id = ? AND email_id = ? "
+                                    "AND state = ? AND worker = ? AND lease_until >= ?",
+                                    (now + visibility_timeout, campaign_id, email_id, LEASED, worker_id, now))
+                if cursor.rowcount:
+                    held.add((campaign_id, email_id))
+        return held
+
+    """
+    Makes jobs leased by the worker visible to other workers again, without sending them.
+    """
+    def release(self, worker_id, keys):
+        with self._transaction() as db:
+            db.executemany("UPDATE jobs SET state = ?, worker = NULL, lease_until = NULL "
+                           "WHERE campaign_id = ? AND email_id = ? AND state = ? AND worker = ?",
+                           [(QUEUED, campaign_id, email_id, LEASED, worker_id) for campaign_id, email_id in keys])
+
+    """
+    Records the results of jobs leased by the worker. Prepared emails of completed jobs are dropped.
+    Parameters:
+        worker_id (str): Id of the worker holding the leases.
+        results (list[tuple[str, int, str]]): (campaign id, email id, result) of each job.
+    """
+    def complete(self, worker_id, results):
+        with self._transaction() as db:
+            db.executemany("UPDATE jobs SET state = ?, result = ?, prepared = NULL, worker = NULL "
+                           "WHERE campaign_id = ? AND email_id = ? AND state = ? AND worker = ?",
+                           [(DONE, result, campaign_id, email_id, LEASED, worker_id)
+                            for campaign_id, email_id, result in results])
+
+    """
+    Queues jobs leased by the worker again, to be retried after a delay.
+    Parameters:
+        worker_id (str): Id of the worker holding the leases.
+        retries (list[tuple[str, int, int, float]]): (campaign id, email id, attempts so far, seconds to wait) of each job.
+    """
+    def retry_later(self, worker_id, retries):
+        now = time.time()
+        with self._transaction() as db:
+            db.executemany("UPDATE jobs SET state = ?, attempts = ?, lease_until = ?, worker = NULL "
+                           "WHERE campaign_id = ? AND email_id = ? AND state = ? AND worker = ?",
+                           [(QUEUED, attempts, now + delay, campaign_id, email_id, LEASED, worker_id)
+                            for campaign_id, email_id, attempts, delay in retries])
+
+    """
+    Records jobs leased by the worker that are out of attempts as dead, keeping their prepared emails.
+    Parameters:
+        worker_id (str): Id of the worker holding the leases.
+        results (list[tuple[str, int, int, str]]): (campaign id, email id, attempts, last error) of each job.
+    """
+    def dead_letter(self, worker_id, results):
+        with self._transaction() as db:
+            db.executemany("UPDATE jobs SET state = ?, attempts = ?, result = ?, worker = NULL "
+                           "WHERE campaign_id = ? AND email_id = ? AND state = ? AND worker = ?",
+                           [(DEAD, attempts, result, campaign_id, email_id, LEASED, worker_id)
+                            for campaign_id, email_id, attempts, result in results])
+
+    """
+    Returns results of a campaign's consecutive done (or dead) jobs, starting from the given email id.
+    """
+    def get_results(self, campaign_id, first_id, limit=1000) -> list[str]:
+        with self._lock:
+            rows = self._db.execute("SELECT email_id, result FROM jobs WHERE campaign_id = ? AND email_id >= ? "
+                                    "AND state IN (?, ?) ORDER BY email_id LIMIT ?",
+                                    (campaign_id, first_id, DONE, DEAD, limit)).fetchall()
+        results = []
+        for email_id, result in rows:
+            if email_id != first_id + len(results):
+                break
+            results.append(result)
+        return results
+
+    """
+    Returns (email id, result) of each of the given jobs of a campaign that is done (or dead).
+    """
+    def get_final_results(self, campaign_id, email_ids) -> list[tuple[int, str]]:
+        email_ids = list(email_ids)
+        results = []
+        with self._lock:
+            # Looked up in slices, within SQLite's limit on the number of parameters
+            for i in range(0, len(email_ids), 500):
+                chunk = email_ids[i:i + 500]
+                results += self._db.execute(f"SELECT email_id, result FROM jobs WHERE campaign_id = ? AND state IN (?, ?) "
+                                            f"AND email_id IN ({', '.join('?' * len(chunk))})",
+                                            (campaign_id, DONE, DEAD, *chunk)).fetchall()
+        return results
+
+    """
+    Returns (email id, last error, attempts) of each dead job of a campaign.
+    """
+    def dead_letters(self, campaign_id) -> list[tuple[int, str, int]]:
+        with self._lock:
+            return self._db.execute("SELECT email_id, result, attempts FROM jobs WHERE campaign_id = ? AND state = ? "
+                                    "ORDER BY email_id", (campaign_id, DEAD)).fetchall()
+
+    """
+    Queues a campaign's dead jobs again, with all their attempts.
+    Returns: (list[int]): Email ids of the jobs queued again.
+    """
+    def redrive(self, campaign_id) -> list[int]:
+        with self._transaction() as db:
+            email_ids = [email_id for email_id, in db.execute("SELECT email_id FROM jobs WHERE campaign_id = ? AND state = ?",
+                                                              (campaign_id, DEAD))]
+            db.execute("UPDATE jobs SET state = ?, attempts = 0, lease_until = NULL WHERE campaign_id = ? AND state = ?",
+                       (QUEUED, campaign_id, DEAD))
+        return email_ids
+
+    """
+    Returns the number of a campaign's jobs waiting to be retried, and of dead jobs.
+    """
+    def retry_state(self, campaign_id) -> dict:
+        with self._lock:
+            retries, dead_letters = self._db.execute(
+                "SELECT IFNULL(SUM(state = ? AND attempts > 0), 0), IFNULL(SUM(state = ?), 0) FROM jobs "
+                "WHERE campaign_id = ?", (QUEUED, DEAD, campaign_id)).fetchone()
+        return {"retries_scheduled": retries, "dead_letters": dead_letters}
+
+    """
+    Removes a campaign's jobs that have not been leased yet, so that they are not sent.
+    Jobs already leased by a worker are still sent.
+    """
+    def cancel(self, campaign_id):
+        with self._transaction() as db:
+            db.execute("DELETE FROM jobs WHERE campaign_id = ? AND state = ?", (campaign_id, QUEUED))
+
+    """
+    Removes all jobs of a campaign.
+    """
+    def forget(self, campaign_id):
+        with self._transaction() as db:
+            db.execute("DELETE FROM jobs WHERE campaign_id = ?", (campaign_id,))
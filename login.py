@@ -3,18 +3,36 @@ from flask_dance.contrib.google import google
 from wtforms import Form, StringField, PasswordField, validators, ValidationError
 from wtforms.csrf.session import SessionCSRF
 from email.message import EmailMessage
+from email.parser import BytesParser
+from email.policy import HTTP
 from base64 import urlsafe_b64encode, b64encode
-from smtp_connection import SMTP_Connection
+from smtp_connection import SMTP_Connection_Pool
 from datetime import timedelta
 from flask import session
 from parser import EMAIL_REGEX
+from http.client import responses
+from retry_scheduler import Send_Error, http_error
 import keyring
 import json
+import uuid
 import re
 
 SMTP_SERVERS = {"gmail.com": "smtp.gmail.com", 
                 "hotmail.com": "smtp-mail.outlook.com", 
                 "outlook.com": "smtp-mail.outlook.com"}
+# Concurrent authenticated SMTP sessions allowed per account by each mail server
+SMTP_SESSIONS = {"smtp.gmail.com": 3,
+                 "smtp-mail.outlook.com": 3}
+# Rate limit profiles (see rate_limiter.RATE_PROFILES) of each mail server
+SMTP_RATE_PROFILES = {"smtp.gmail.com": "smtp_gmail",
+                      "smtp-mail.outlook.com": "smtp_outlook"}
+
+# Batch endpoints of the Gmail API and Microsoft Graph, relative to each OAuth session's base url
+GMAIL_BATCH_URL = "/batch/gmail/v1"
+GRAPH_BATCH_URL = "/v1.0/$batch"
+# Maximum number of messages sent in a single batch request
+GMAIL_BATCH_SIZE = 50
+GRAPH_BATCH_SIZE = 20
 
 def retrieve_secret(key_name):
     return keyring.get_password('SmartMailerApp', key_name)
@@ -52,6 +70,10 @@ class User:
     def __init__(self):
         self.email = None
         self.email_type = None
+        self.rate_profile = None
+        self.batch_size = 1
+        # Whether emails can be sent from outside this user's requests, e.g. by a standalone worker
+        self.sends_outside_requests = False
         self.is_authenticated = False
         self.is_active = False
         self.is_anonymous = False
@@ -77,6 +99,54 @@ class User:
         msg.set_content(body, subtype="html")
         return msg
     
+    """
+    Crafts an email and serializes it into the form sent to the email server.
+    This is the CPU heavy part of sending, and can be done ahead of sending.
+    Parameters:
+        recipient (str): receiver of email to be crafted.
+        subject (str): subject of email to be crafted.
+        body (str): body content of email to be crafted.
+    Returns: Prepared email, to be passed to send_prepared() or send_prepared_batch().
+    """
+    def prepare_message(self, recipient, subject, body):
+        return self._get_message(recipient, subject, body)
+
+    """
+    Sends an email prepared by prepare_message().
+    Returns: (str): Error messages from sending email. Empty if successful.
+    """
+    def send_prepared(self, prepared):
+        return f"Error: Sending is not supported for {self.email_type} accounts"
+
+    """
+    Sends several emails prepared by prepare_message(), in as few requests as the email server allows.
+    Parameters:
+        prepared_list (list): Prepared emails, at most batch_size.
+    Returns: (list[str]): Result of sending each email, in the same order.
+    """
+    def send_prepared_batch(self, prepared_list):
+        return [self.send_prepared(prepared) for prepared in prepared_list]
+
+    """
+    Crafts an email and sends that email to target recipient.
+    Parameters:
+        recipient (str): receiver of email to be crafted.
+        subject (str): subject of email to be crafted.
+        body (str): body content of email to be crafted.
+    Returns: (str): Error messages from sending email. Empty if successful.
+    """
+    def send_message(self, recipient, subject, body):
+        return self.send_prepared(self.prepare_message(recipient, subject, body))
+
+    """
+    Crafts and sends several emails, in as few requests as the email server allows.
+    Parameters:
+        messages (list[tuple[str, str, str]]): recipient, subject and body of each email, at most batch_size.
+    Returns: (list[str]): Result of sending each email, in the same order.
+    """
+    def send_messages(self, messages):
+        return self.send_prepared_batch([self.prepare_message(*message) for message in messages])
+
     """
     Loads the user with the matching user_id from keyring.
     Parameters:
@@ -117,24 +187,29 @@ class SMTP_User(User):
         self.email_type = "smtp"
         self.email = email
         self.password = password
-        self.email_sender = SMTP_Connection(SMTP_SERVERS[email_server], 587, email, password)
+        smtp_server = SMTP_SERVERS[email_server]
+        self.email_sender = SMTP_Connection_Pool(smtp_server, 587, email, password, SMTP_SESSIONS[smtp_server])
+        self.rate_profile = SMTP_RATE_PROFILES[smtp_server]
+        self.sends_outside_requests = True
         self.is_authenticated = True
         self.is_active = True
 
     """
-    Crafts an email and sends that email to target recipient.
-    Parameters:
-        recipient (str): receiver of email to be crafted.
-        subject (str): subject of email to be crafted.
-        body (str): body content of email to be crafted.
+    Crafts an email and serializes it into MIME format.
+    Returns: (tuple[str, bytes]): Recipient and serialized email.
+    """
+    def prepare_message(self, recipient, subject, body):
+        msg = self._get_message(recipient, subject, body)
+        # Bytes are sent as is by smtplib, so they are serialized with the CRLF line endings SMTP requires
+        return recipient, msg.as_bytes(policy=msg.policy.clone(linesep="\r\n"))
+
+    """
+    Sends an email prepared by prepare_message() to its recipient.
     Returns: (str): Error messages from sending email. Empty if successful.
     """
-    def send_message(self, recipient, subject, body):
-        if not self.email_sender.smtp:
-            result = self.email_sender.connect()
-            if result != "Success":
-                return result
-        return self.email_sender.send_message(self._get_message(recipient, subject, body))
+    def send_prepared(self, prepared):
+        recipient, data = prepared
+        return self.email_sender.send_prepared(self.email, recipient, data)
 
 """
 Encapsulates a signed in Google account using OAuth.
@@ -145,27 +220,102 @@ class Google_User(User):
         super().__init__()
         self.email_type = "google"
         self.email = email
+        self.rate_profile = "gmail_api"
+        self.batch_size = GMAIL_BATCH_SIZE
         self.session = google._get_current_object()
         self.is_authenticated = self.session.authorized
         self.is_active = self.is_authenticated
 
     """
-    Crafts an email and sends that email to target recipient.
-    Parameters:
-        recipient (str): receiver of email to be crafted.
-        subject (str): subject of email to be crafted.
-        body (str): body content of email to be crafted.
-    Returns: (str): Error messages from sending email. Empty if successful.
+    Crafts an email and encodes it for the Gmail API.
+    Returns: (str): JSON request body containing the base64url encoded email.
     """
-    def send_message(self, recipient, subject, body):
+    def prepare_message(self, recipient, subject, body):
         msg = self._get_message(recipient, subject, body)
         encoded_message = urlsafe_b64encode(msg.as_bytes()).decode()
-        json_message = {"raw": encoded_message}
-        rsp = self.session.post(f"/gmail/v1/users/{self.email}/messages/send", json=json_message)
-        if not rsp.ok or "labelIds" not in rsp.json() or "SENT" not in rsp.json()["labelIds"]:
-            return "Error: " + rsp.reason
+        return json.dumps({"raw": encoded_message})
+
+    """
+    Sends an email prepared by prepare_message() to its recipient.
+    Returns: (str): Error messages from sending email. Empty if successful.
+    """
+    def send_prepared(self, prepared):
+        headers = {"Content-Type": "application/json"}
+        rsp = self.session.post(f"/gmail/v1/users/{self.email}/messages/send", data=prepared, headers=headers)
+        if not rsp.ok:
+            return http_error(rsp.status_code, rsp.reason, rsp.headers.get("Retry-After"))
+        if "labelIds" not in rsp.json() or "SENT" not in rsp.json()["labelIds"]:
+            return Send_Error("Error: " + rsp.reason)
         return "✓"
 
+    """
+    Sends emails prepared by prepare_message() in a single request to the Gmail batch endpoint.
+    Parameters:
+        prepared_list (list[str]): Prepared emails, at most batch_size.
+    Returns: (list[str]): Result of sending each email, in the same order.
+    """
+    def send_prepared_batch(self, prepared_list):
+        boundary = f"batch_{uuid.uuid4().hex}"
+        parts = []
+        for i, json_message in enumerate(prepared_list):
+            parts.append(f"--{boundary}\r\n"
+                         f"Content-Type: application/http\r\n"
+                         f"Content-ID: <item{i}>\r\n\r\n"
+                         f"POST /gmail/v1/users/{self.email}/messages/send\r\n"
+                         f"Content-Type: application/json\r\n\r\n"
+                         f"{json_message}\r\n")
+        parts.append(f"--{boundary}--\r\n")
+        headers = {"Content-Type": f"multipart/mixed; boundary={boundary}"}
+        rsp = self.session.post(GMAIL_BATCH_URL, data=''.join(parts), headers=headers)
+        if not rsp.ok:
+            return [http_error(rsp.status_code, rsp.reason, rsp.headers.get("Retry-After"))] * len(prepared_list)
+        return parse_gmail_batch_response(rsp.headers.get("Content-Type"), rsp.content, len(prepared_list))
+
+"""
+Parses the multipart/mixed response of a Gmail API batch request into the result of each email.
+Emails without a readable response (e.g. a part without Content-ID or status line) may not have been sent,
+so they are given a transient error, to be retried.
+Parameters:
+    content_type (str): Content-Type header of the response, with its boundary. None if missing.
+    content (bytes): Body of the response.
+    count (int): Number of emails in the batch request.
+Returns: (list[str]): Result of each email, in request order.
+"""
+def parse_gmail_batch_response(content_type, content, count) -> list[str]:
+    results = [Send_Error("Error: No response", transient=True)] * count
+    if not content_type:
+        return results
+    batch = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + content)
+    if not batch.is_multipart():
+        return results
+    for part in batch.iter_parts():
+        # Content-ID of each response is <response-item{i}>, matching the request it answers
+        match = re.search(r"item(\d+)>?$", (part.get("Content-ID") or "").strip())
+        payload = part.get_payload()
+        if not match or int(match.group(1)) >= count or not isinstance(payload, str):
+            continue
+        status_line, _, http_message = payload.replace("\r\n", "\n").lstrip("\n").partition("\n")
+        status_match = re.match(r"HTTP/\S+\s+(\d{3})", status_line)
+        if not status_match:
+            continue
+        i, status = int(match.group(1)), int(status_match.group(1))
+        response_headers, separator, response_content = http_message.partition("\n\n")
+        if not separator:
+            response_headers, response_content = "", http_message
+        try:
+            label_ids = json.loads(response_content).get("labelIds", [])
+        except (json.JSONDecodeError, AttributeError):
+            label_ids = []
+        if status // 100 != 2:
+            retry_after = re.search(r"^retry-after:\s*(.+)$", response_headers, re.IGNORECASE | re.MULTILINE)
+            results[i] = http_error(status, responses.get(status, str(status)),
+                                    retry_after.group(1).strip() if retry_after else None)
+        elif "SENT" not in label_ids:
+            results[i] = Send_Error("Error: " + responses.get(status, str(status)))
+        else:
+            results[i] = "✓"
+    return results
+
 """
 Encapsulates a signed in Azure account using OAuth.
 An object should be instantiated only be called AFTER it has been authorized.
@@ -175,25 +325,81 @@ class Azure_User(User):
         super().__init__()
         self.email_type = "azure"
         self.email = email
+        self.rate_profile = "graph"
+        self.batch_size = GRAPH_BATCH_SIZE
         self.session = azure._get_current_object()
         self.is_authenticated = self.session.authorized
         self.is_active = self.is_authenticated
     
     """
-    Crafts an email and sends that email to target recipient
-    Parameters:
-        recipient (str): receiver of email to be crafted.
-        subject (str): subject of email to be crafted.
-        body (str): body content of email to be crafted.
-    Returns: (str): Error messages from sending email. Empty if successful.
+    Crafts an email and encodes it for Microsoft Graph.
+    Returns: (str): Base64 encoded email.
     """
-    def send_message(self, recipient, subject, body):
+    def prepare_message(self, recipient, subject, body):
         msg = self._get_message(recipient, subject, body)
-        encoded_message = b64encode(msg.as_bytes()).decode()
+        return b64encode(msg.as_bytes()).decode()
+
+    """
+    Sends an email prepared by prepare_message() to its recipient.
+    Returns: (str): Error messages from sending email. Empty if successful.
+    """
+    def send_prepared(self, prepared):
         headers = {"Authorization": f'Bearer {self.session.access_token}', "Content-Type": "text/plain"}
-        rsp = self.session.post("/v1.0/me/sendMail", data=encoded_message, headers=headers)
+        rsp = self.session.post("/v1.0/me/sendMail", data=prepared, headers=headers)
         if (not rsp.ok):
-            return "Error: " + rsp.reason
+            return http_error(rsp.status_code, rsp.reason, rsp.headers.get("Retry-After"))
         return "✓"
 
- 
\ No newline at end of file
+    """
+    Sends emails prepared by prepare_message() in a single request to the Microsoft Graph JSON batch endpoint.
+    Parameters:
+        prepared_list (list[str]): Prepared emails, at most batch_size.
+    Returns: (list[str]): Result of sending each email, in the same order.
+    """
+    def send_prepared_batch(self, prepared_list):
+        batch_requests = []
+        for i, encoded_message in enumerate(prepared_list):
+            batch_requests.append({"id": str(i),
+                                   "method": "POST",
+                                   "url": "/me/sendMail",
+                                   "headers": {"Content-Type": "text/plain"},
+                                   "body": encoded_message})
+        headers = {"Authorization": f'Bearer {self.session.access_token}'}
+        rsp = self.session.post(GRAPH_BATCH_URL, json={"requests": batch_requests}, headers=headers)
+        if (not rsp.ok):
+            return [http_error(rsp.status_code, rsp.reason, rsp.headers.get("Retry-After"))] * len(prepared_list)
+
+        try:
+            data = rsp.json()
+        except ValueError:
+            data = {}
+        return parse_graph_batch_response(data, len(prepared_list))
+
+ 
+
+"""
+Parses the JSON response of a Microsoft Graph batch request into the result of each email.
+Emails without a readable response may not have been sent, so they are given a transient error, to be retried.
+Parameters:
+    data (dict): Decoded body of the response.
+    count (int): Number of emails in the batch request.
+Returns: (list[str]): Result of each email, in request order.
+"""
+def parse_graph_batch_response(data, count) -> list[str]:
+    results = [Send_Error("Error: No response", transient=True)] * count
+    batch_responses = data.get("responses") if isinstance(data, dict) else None
+    # Responses may be in any order, and are matched to their requests by id
+    for response in batch_responses if isinstance(batch_responses, list) else []:
+        try:
+            i, status = int(response["id"]), int(response["status"])
+        except (TypeError, KeyError, ValueError):
+            continue
+        if not 0 <= i < count:
+            continue
+        if status // 100 != 2:
+            response_headers = response.get("headers") or {}
+            retry_after = {name.lower(): value for name, value in response_headers.items()}.get("retry-after")
+            results[i] = http_error(status, responses.get(status, str(status)), retry_after)
+        else:
+            results[i] = "✓"
+    return results
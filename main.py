@@ -3,18 +3,28 @@ This script runs the application using a development server.
 It contains the definition of routes and views for the application.
 """
 
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, Response, session
 from flask_login import LoginManager, login_user, logout_user, current_user
+from werkzeug.serving import is_running_from_reloader
 from flask_dance.contrib.google import make_google_blueprint, google
 from flask_dance.contrib.azure import make_azure_blueprint, azure
 from oauthlib.oauth2.rfc6749.errors import InvalidGrantError, TokenExpiredError 
-from parser import Parser
-from image_link import Image_Count_Manager
-from email_manager import Email_Manager
+from parser import Invalid_Emails_Error
+from parse_cache import Parse_Cache
+from hit_store import Hit_Store
+from campaign_registry import Campaign_Registry
+from send_journal import Send_Journal, CLAIM_TIMEOUT
+from job_queue import Job_Queue
+from rate_limiter import get_rate_limiter
 from login import LoginForm, User, SMTP_User, Google_User, Azure_User
 import os
 import keyring
+import base64
 import json
+import re
+import threading
+import csv
+import io
 
 app = Flask(__name__)
 app.secret_key = "testing"
@@ -51,8 +61,36 @@ wsgi_app = app.wsgi_app
 UPLOAD_FOLDER = 'uploads'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-image_count_manager = Image_Count_Manager()
-email_manager = Email_Manager()
+# Mail data CSVs larger than this are validated and prepared in chunks, to keep memory usage flat
+STREAMING_CSV_SIZE = 64 * 1024 * 1024
+CSV_CHUNK_SIZE = 50000
+# Seconds between keep-alive comments on an idle send status stream
+SSE_KEEPALIVE = 15
+# Number of rows of the email table returned per page, by default and at most
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Number of tracking image counts that can be looked up per request
+MAX_TRACKING_COUNT_IDS = 5000
+
+# If set, emails are enqueued in this shared job queue and sent by standalone workers (see worker.py),
+# and rate limits are shared with them and with other processes of the application
+SEND_QUEUE_PATH = os.environ.get("SEND_QUEUE_PATH")
+# Processes of the render pool (see parser.py) are started with forkserver or spawn, which run this module again as
+# __mp_main__ when the application is started with `python main.py`. They only render emails, so databases,
+# background threads and campaigns are only set up in the application itself.
+IS_RENDER_PROCESS = __name__ == "__mp_main__"
+# With the development server's reloader (app.run(debug=True) below), this module is also run by a parent process that
+# only watches for changes and restarts the process serving requests. Campaigns are only restored in the latter.
+IS_RELOADER_PROCESS = __name__ == "__main__" and not is_running_from_reloader()
+IS_APP_PROCESS = not (IS_RENDER_PROCESS or IS_RELOADER_PROCESS)
+if IS_APP_PROCESS:
+    hit_store = Hit_Store()
+    parse_cache = Parse_Cache()
+    send_journal = Send_Journal()
+    job_queue = Job_Queue(SEND_QUEUE_PATH) if SEND_QUEUE_PATH else None
+    # Each upload is a campaign of the user, with its own parser and send state.
+    # Campaigns interrupted by a restart are restored from the send journal.
+    campaigns = Campaign_Registry(UPLOAD_FOLDER, hit_store, send_journal, job_queue)
 
 def store_secret(key_name, secret_value):
     keyring.set_password('SmartMailerApp', key_name, secret_value)
@@ -61,12 +99,26 @@ def retrieve_secret(key_name):
 def delete_secret(key_name):
     keyring.delete_password('SmartMailerApp', key_name)
 
-parser = None
+# 1x1 transparent PNG served as the tracking image
+TRACKING_IMAGE = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII=")
+# Unique ids of tracking images, as generated by the parser
+TRACKING_ID_REGEX = re.compile(r"[0-9a-f]{32}")
 
 # Ensure the upload folder exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 
+def get_campaign():
+    """
+    Returns the current user's campaign given in the request, or else the one last uploaded in this session.
+    None if there is no such campaign, e.g. if it has been evicted.
+    """
+    campaign_id = request.values.get("campaign") or session.get("campaign_id")
+    if not current_user.is_authenticated or not campaign_id:
+        return None
+    return campaigns.get(current_user.get_id(), campaign_id)
+
+
 @app.route('/')
 def index():
     if not current_user.is_authenticated:
@@ -78,6 +130,32 @@ def load_user(user_id):
     # Note: This function will be ran with every page refresh by flask_login to ensure security.
     return User.load(user_id)
 
+# Campaigns interrupted by a restart continue sending as soon as their user is available
+@app.before_request
+def resume_campaigns():
+    if current_user.is_authenticated:
+        campaigns.resume(current_user._get_current_object())
+
+def resume_campaigns_on_startup():
+    still_claimed = False
+    for user_id in campaigns.users_to_resume():
+        try:
+            user = User.load(user_id)
+        except Exception:
+            # OAuth users can only be loaded within their own requests, and are resumed on their next request
+            continue
+        if user and user.is_authenticated:
+            campaigns.resume(user)
+            still_claimed = still_claimed or user_id in campaigns.users_to_resume()
+    # Campaigns claimed by another process (or one that stopped without releasing them) are tried again later
+    if still_claimed:
+        timer = threading.Timer(CLAIM_TIMEOUT, resume_campaigns_on_startup)
+        timer.daemon = True
+        timer.start()
+
+if IS_APP_PROCESS:
+    resume_campaigns_on_startup()
+
 @app.route('/logout', methods=['GET'])
 def logout():
     if current_user.is_authenticated:
@@ -159,20 +237,27 @@ def upload_file():
         flash('No selected file(s)')
         return redirect(url_for('index'))
     if csv_file and body_file:
-        #get file paths for both and put them in the uploads folder
-        csv_name = csv_file.filename
-        csvpath = os.path.join(app.config['UPLOAD_FOLDER'], csv_name)
+        # every upload starts a new campaign, with its own folder in the uploads folder
+        campaign = campaigns.create(current_user.get_id())
+        session['campaign_id'] = campaign.id
+
+        #get file paths for both and put them in the campaign's upload folder
+        csvpath = campaign.upload_path(csv_file.filename)
         csv_file.save(csvpath)
 
-        body_name = body_file.filename
-        bodypath = os.path.join(app.config['UPLOAD_FOLDER'], body_name)
+        bodypath = campaign.upload_path(body_file.filename)
         body_file.save(bodypath)
 
         #using the parser class to prepare the emails
         try:
-            # set the global parser variable
-            global parser
-            parser = Parser(csvpath, bodypath)
+            chunk_size = CSV_CHUNK_SIZE if os.path.getsize(csvpath) > STREAMING_CSV_SIZE else None
+            campaign.parser = parser = parse_cache.get_parser(csvpath, bodypath, chunk_size)
+        except Invalid_Emails_Error as e:
+            campaign.invalid_emails = e.invalid_emails
+            flash(f"{e}")
+            flash(f"The full list of invalid email addresses is available at "
+                  f"{url_for('invalid_emails_report', campaign=campaign.id)}")
+            return redirect(url_for('index'))
         except Exception as e:
             flash(f"{e}")
             return redirect(url_for('index'))
@@ -185,23 +270,28 @@ def upload_file():
         department = department_input if department_input else "all"
         try:
             if "view-counts" in request.form:
-                emails = parser.prepare_all_emails(department, attach_transparent_images=False)
-                parser.update_report_data(emails)
+                # Bodies are only rendered when shown, so that viewing a large campaign does not hold all of them
+                campaign.viewed_emails = parser.prepare_all_emails(department, attach_transparent_images=False,
+                                                                   keep_bodies=False)
+                campaign.viewed_headers = parser.headers
+                parser.update_report_counts(department)
                 report = parser.prepare_report()
-                hashes = [email['hash'] for email in emails]
-                image_count_manager.update_unique_id_list(hashes)
-                return render_template('upload.html', emails=emails, headers=parser.headers,
-                                       report=report, is_send=False)
+                hashes = [email['hash'] for email in campaign.viewed_emails]
+                campaign.image_count_manager.update_unique_id_list(hashes)
+                return render_template('upload.html', headers=parser.headers, report=report, is_send=False,
+                                       num_emails=len(campaign.viewed_emails), departments=sorted(parser.departments),
+                                       campaign=campaign.id)
 
             elif "preview-emails" in request.form:
                 email = parser.prepare_first_email()
                 placeholders = ['#' + header + '#' for header in parser.headers]
                 placeholders = ', '.join(placeholders)
                 
-                if not email_manager.allow_next_batch():
+                if not campaign.email_manager.allow_next_batch():
                     return redirect(url_for('index'))
 
                 return render_template('preview.html', 
+                                       campaign=campaign.id,
                                        department=department, 
                                        subject=email['subject'], 
                                        body=email['body'],
@@ -220,17 +310,21 @@ def preview_and_send():
     try:
         if "go-back" in request.form:
             return redirect(url_for('index'))
+
+        campaign = get_campaign()
+        if campaign is None or campaign.parser is None:
+            flash("The uploaded files were not found. Please upload them again.")
+            return redirect(url_for('index'))
+        email_manager = campaign.email_manager
         
         if email_manager.is_sending():
             flash("Note: The current batch of emails are still being sent. Previewing emails being sent instead.")
-            return redirect(url_for('sent_emails'))
+            return redirect(url_for('sent_emails', campaign=campaign.id))
         
-        emails = parser.prepare_all_emails(request.form.get('department'))
-        parser.update_report_data(emails)
-        email_manager.store_header_and_report(parser.headers, parser.prepare_report())
-        email_manager.send_emails(current_user._get_current_object(), emails)
+        department = request.form.get('department')
+        campaign.send(current_user._get_current_object(), department)
 
-        return redirect(url_for('sent_emails'))
+        return redirect(url_for('sent_emails', campaign=campaign.id))
 
     except Exception as e:
         flash(f'An error occurred: {str(e)}')
@@ -238,27 +332,177 @@ def preview_and_send():
 
 @app.get('/sent_emails')
 def sent_emails():
-    if not email_manager.headers:
+    if not current_user.is_authenticated:
+        return redirect(url_for('login'))
+    campaign = get_campaign()
+    if campaign is None or not campaign.email_manager.headers:
         flash("No recently sent emails were found.")
         return redirect(url_for('index'))
 
+    email_manager = campaign.email_manager
     hashes = [email['hash'] for email in email_manager.emails]
-    image_count_manager.update_unique_id_list(hashes)
-    return render_template('upload.html', emails=email_manager.emails, headers=email_manager.headers,
-                            report=email_manager.report, is_send=True)
+    campaign.image_count_manager.update_unique_id_list(hashes)
+    departments = sorted({email.department for email in email_manager.emails})
+    return render_template('upload.html', headers=email_manager.headers, report=email_manager.report, is_send=True,
+                           num_emails=len(email_manager.emails), departments=departments, campaign=campaign.id)
 
 @app.get("/cancel_sending_emails")
 def cancel_sending_emails():
-    email_manager.cancel()
-    return redirect(url_for('sent_emails'))
+    campaign = get_campaign()
+    if campaign is None:
+        flash("There are no emails currently being sent to cancel.")
+        return redirect(url_for('index'))
+    campaign.email_manager.cancel()
+    return redirect(url_for('sent_emails', campaign=campaign.id))
+
+# Emails that still failed with a transient error (e.g. throttling) after all attempts
+@app.get("/dead_letters")
+def dead_letters_report():
+    campaign = get_campaign()
+    dead_letters = campaign.email_manager.dead_letters() if campaign else []
+    # Errors are free text, so they are quoted as needed
+    report = io.StringIO()
+    writer = csv.writer(report)
+    writer.writerow(["email", "error", "attempts"])
+    writer.writerows([letter["email"], letter["error"], letter["attempts"]] for letter in dead_letters)
+    return report.getvalue(), {"Content-Type": "text/csv",
+                                      "Content-Disposition": "attachment; filename=dead_letters.csv"}
+
+@app.post("/redrive_dead_letters")
+def redrive_dead_letters():
+    if not current_user.is_authenticated:
+        return redirect(url_for('login'))
+    campaign = get_campaign()
+    if campaign is None:
+        flash("There are no sent emails to retry.")
+        return redirect(url_for('index'))
+    campaign.email_manager.redrive_dead_letters()
+    return redirect(url_for('sent_emails', campaign=campaign.id))
 
 @app.get("/update_send_status")
 def update_send_status():
-    return email_manager.results
+    campaign = get_campaign()
+    return campaign.email_manager.results if campaign else []
+
+# Server-Sent Events stream of send results. Each event carries only the results after the client's cursor,
+# which the browser sends back as Last-Event-ID when it reconnects.
+@app.get("/send_status_stream")
+def send_status_stream():
+    campaign = get_campaign()
+    if campaign is None:
+        return {"error": "No such campaign"}, 404
+    email_manager = campaign.email_manager
+    cursor = request.headers.get("Last-Event-ID", type=int)
+    if cursor is None:
+        cursor = request.args.get("cursor", 0, type=int)
+
+    def stream(cursor):
+        while True:
+            results, finished = email_manager.wait_for_results(cursor, SSE_KEEPALIVE)
+            if results:
+                yield f"id: {cursor + len(results)}\ndata: {json.dumps({'cursor': cursor, 'results': results})}\n\n"
+                cursor += len(results)
+            elif finished:
+                yield "event: done\ndata: {}\n\n"
+                return
+            else:
+                yield ": keep-alive\n\n"
+
+    return Response(stream(cursor), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/send_rate")
+def send_rate():
+    if not current_user.is_authenticated:
+        return redirect(url_for('login'))
+    state = get_rate_limiter(current_user, SEND_QUEUE_PATH).state()
+    state["is_sending"] = any(campaign.is_sending() for campaign in campaigns.user_campaigns(current_user.get_id()))
+    campaign = get_campaign()
+    if campaign is not None:
+        state.update(campaign.email_manager.retry_state())
+    return state
+
+def email_page(campaign, emails, department, offset, limit):
+    """
+    Returns a page of a campaign's emails, optionally only those in the given department.
+    Emails keep their ids, so that they can be matched with send results and view counts.
+    """
+    if not department or department == "all":
+        return len(emails), emails[offset:offset + limit]
+    # Only the positions of the page are looked up, rather than filtering every email
+    positions = campaign.department_positions(emails).get(department, [])
+    return len(positions), [emails[i] for i in positions[offset:offset + limit]]
+
+# Rows of the email table, loaded page by page as the table is scrolled. Bodies are fetched separately.
+@app.get("/api/emails")
+def api_emails():
+    if not current_user.is_authenticated:
+        return redirect(url_for('login'))
+    campaign = get_campaign()
+    if campaign is None:
+        return {"error": "No such campaign"}, 404
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    department = request.args.get("department")
+
+    if request.args.get("source") == "sent":
+        results = campaign.email_manager.results
+        total, page = email_page(campaign, campaign.email_manager.emails, department, offset, limit)
+        rows = [{"id": email.id, "email": email.email, "department": email.department,
+                 "status": results[int(email.id)] if int(email.id) < len(results) else None} for email in page]
+    else:
+        total, page = email_page(campaign, campaign.viewed_emails, department, offset, limit)
+        rows = [{"id": email.id, "email": email.email, "subject": email.subject,
+                 "fields": [email[header] for header in campaign.viewed_headers]} for email in page]
+    return {"total": total, "offset": offset, "rows": rows}
+
+@app.get("/api/emails/<int:email_id>/body")
+def api_email_body(email_id):
+    if not current_user.is_authenticated:
+        return redirect(url_for('login'))
+    campaign = get_campaign()
+    if campaign is None or not 0 <= email_id < len(campaign.viewed_emails):
+        return {"error": "No such email"}, 404
+    return {"body": campaign.parser.render_body_view(campaign.viewed_emails[email_id])}
 
 @app.get("/update_count")
 def update_count():
-    return image_count_manager.get_image_counts()
+    campaign = get_campaign()
+    if campaign is None:
+        return {"version": 0, "counts": {}}
+    return campaign.get_image_counts(request.args.get("since", 0, type=int))
+
+# Tracking image embedded in sent emails. Not login protected, as it is loaded by recipients' mail clients.
+@app.get("/t/<unique_id>.png")
+def tracking_image(unique_id):
+    # Ids are MD5 hex digests of the emails, and are only counted if registered when their email was sent
+    if not TRACKING_ID_REGEX.fullmatch(unique_id):
+        return {"error": "No such tracking image"}, 404
+    hit_store.record(unique_id)
+    return Response(TRACKING_IMAGE, mimetype="image/png",
+                    headers={"Cache-Control": "no-store, no-cache, must-revalidate, max-age=0"})
+
+# Bulk lookup of tracking image counts, e.g. for scripts of a logged in user
+@app.post("/tracking_counts")
+def tracking_counts():
+    if not current_user.is_authenticated:
+        return {"error": "Login required"}, 401
+    data = request.get_json(silent=True)
+    ids = data.get("ids") if isinstance(data, dict) else None
+    if not isinstance(ids, list) or len(ids) > MAX_TRACKING_COUNT_IDS or not all(isinstance(i, str) for i in ids):
+        return {"error": f"Expected a JSON object with a list of at most {MAX_TRACKING_COUNT_IDS} ids"}, 400
+    return {"counts": hit_store.get_counts(ids)}
+
+@app.get("/invalid_emails")
+def invalid_emails_report():
+    campaign = get_campaign()
+    invalid_emails = campaign.invalid_emails if campaign else []
+    # Invalid emails are whatever the file contained (commas, quotes, newlines), so they are quoted as needed
+    report = io.StringIO()
+    writer = csv.writer(report)
+    writer.writerow(["line", "email"])
+    writer.writerows(invalid_emails)
+    return report.getvalue(), {"Content-Type": "text/csv",
+                               "Content-Disposition": "attachment; filename=invalid_emails.csv"}
 
 #if needed
 @app.route('/about')
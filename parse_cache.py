@@ -0,0 +1,89 @@
+from collections import OrderedDict
+from threading import Lock
+from parser import Parser
+import hashlib
+import copy
+
+# Cached parsers are evicted (least recently used first) beyond these limits
+MAX_CACHED_PARSERS = 8
+MAX_CACHE_BYTES = 512 * 1024 * 1024
+READ_BLOCK_SIZE = 1024 * 1024
+
+"""
+Returns the SHA-256 digest of the contents of a file.
+"""
+def file_digest(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(READ_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+"""
+Caches parsed mail data and body, keyed by the contents of the uploaded files.
+Re-submitting identical files skips reading, validating and compiling them again.
+Streaming parsers are not cached, as they re-read their files when preparing emails.
+Each caller is given its own shallow copy of a cached parser, so that their reports are kept separate.
+"""
+class Parse_Cache:
+    def __init__(self, max_entries=MAX_CACHED_PARSERS, max_bytes=MAX_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict() # key -> (parser, size in bytes), least recently used first
+        self._lock = Lock()
+
+    """
+    Estimates the memory used by a parser, in bytes.
+    """
+    @staticmethod
+    def _estimate_size(parser) -> int:
+        return int(parser.mail_data_df.memory_usage(deep=True).sum()) + len(parser.subject) + len(parser.body)
+
+    """
+    Returns a shallow copy of a cached parser, with its own empty report, for the caller's own copy of its files.
+    Parsed mail data and compiled templates are shared, as they are never modified.
+    The copy refers to the caller's files, as the files first parsed may be deleted along with their campaign,
+    while the copy's paths are used to parse them again after a restart.
+    """
+    @staticmethod
+    def _copy(parser, mail_data_path, mail_body_path) -> Parser:
+        parser = copy.copy(parser)
+        parser.mail_data_path = mail_data_path
+        parser.mail_body_path = mail_body_path
+        parser.reset_report()
+        return parser
+
+    """
+    Returns a parser for the given files, creating it only if identical files have not been parsed before.
+    Parameters:
+        mail_data_path (str): Path to mail data CSV file.
+        mail_body_path (str): Path to mail body txt file.
+        chunk_size (int): Number of rows read at a time in streaming mode. None to read the whole file at once.
+    Returns: (Parser): Parser for the given files.
+    """
+    def get_parser(self, mail_data_path, mail_body_path, chunk_size=None) -> Parser:
+        if chunk_size:
+            return Parser(mail_data_path, mail_body_path, chunk_size)
+
+        key = (file_digest(mail_data_path), file_digest(mail_body_path))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._copy(self._entries[key][0], mail_data_path, mail_body_path)
+
+        parser = Parser(mail_data_path, mail_body_path)
+        size = self._estimate_size(parser)
+        if size > self.max_bytes:
+            return parser
+        # The cached parser itself is never handed out, so its report is never modified
+        cached, parser = parser, self._copy(parser, mail_data_path, mail_body_path)
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (cached, size)
+                self.total_bytes += size
+            while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+        return parser
@@ -1,7 +1,14 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from image_link import make_image_links
+from itertools import repeat
+from prepared_email import Email_Metadata, Prepared_Email, attach_transparent_image
 import pandas as pd
-import asyncio
+import numpy as np
+from threading import Lock
+import multiprocessing
 import hashlib
+import os
 import re
 
 # Email regex is roughly based on RFC 5322 and 1034 of Internet Message Format
@@ -9,6 +16,147 @@ import re
 # Source: https://www.w3.org/TR/2012/WD-html-markup-20120329/input.email.html
 EMAIL_REGEX = re.compile(r'^[a-zA-Z0-9.!#$%&’*+/=?^_`{|}~-]+@[a-zA-Z0-9-]+(?:\.[a-zA-Z0-9-]+)*$')
 
+# Number of invalid email addresses listed in the error message itself
+INVALID_EMAILS_SHOWN = 10
+# Emails are rendered in parallel by RENDER_WORKERS processes when preparing at least PARALLEL_RENDER_MIN_ROWS of them
+RENDER_WORKERS = os.cpu_count() or 1
+PARALLEL_RENDER_MIN_ROWS = 50000
+# Emails are rendered at most RENDER_CHUNK_ROWS at a time, so that rendered subjects and bodies of a large campaign
+# are never all held in memory at once
+RENDER_CHUNK_ROWS = 50000
+
+_render_pool = None
+_render_pool_lock = Lock()
+
+def get_render_pool():
+    """
+    Returns the process pool that renders large campaigns, starting it on first use.
+    A single pool is shared by every parser for the lifetime of the application. Its processes are started with
+    forkserver (or spawn where unavailable) rather than fork, as forking a process running other threads may deadlock.
+
+    Returns:
+    ProcessPoolExecutor: Pool of RENDER_WORKERS processes.
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS,
+                                               mp_context=multiprocessing.get_context(start_method))
+        return _render_pool
+
+def _discard_render_pool(pool):
+    """
+    Drops a broken render pool (e.g. one of its processes was killed), so that the next call starts a new one.
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False)
+
+class Invalid_Emails_Error(ValueError):
+    """
+    Raised when mail data contains email addresses that do not follow the RFC 5322 and 1034 format.
+
+    Attributes:
+    invalid_emails (list[tuple[int, str]]): Line number and email address of every invalid row.
+    """
+    def __init__(self, invalid_emails):
+        self.invalid_emails = invalid_emails
+        shown = ', '.join(f"line {line}: '{email}'" for line, email in invalid_emails[:INVALID_EMAILS_SHOWN])
+        message = f"{len(invalid_emails)} email address(es) do not follow the RFC 5322 and 1034 format ({shown}"
+        if len(invalid_emails) > INVALID_EMAILS_SHOWN:
+            message += f", and {len(invalid_emails) - INVALID_EMAILS_SHOWN} more"
+        super().__init__(message + ")")
+
+def find_invalid_emails(emails):
+    """
+    Validates a whole column of email addresses in one vectorized pass.
+
+    Parameters:
+    emails (pd.Series): Email addresses, indexed by their row number in the mail data CSV.
+
+    Returns:
+    list[tuple[int, str]]: Line number (counting the header line) and email address of every invalid row.
+    """
+    invalid = emails[~emails.str.fullmatch(EMAIL_REGEX.pattern)]
+    return list(zip((invalid.index + 2).tolist(), invalid.tolist()))
+
+def compile_template(template, headers):
+    """
+    Compiles a template into literal chunks and placeholder slots.
+
+    Parameters:
+    template (str): Subject or body template containing #header# placeholders.
+    headers (list): Headers that may be used as placeholders.
+
+    Returns:
+    list: Alternating literal chunks (even indices) and header names (odd indices).
+    """
+    if not headers:
+        return [template]
+    # Longest headers first so that a header which is a prefix of another is not matched early
+    alternatives = '|'.join(re.escape(header) for header in sorted(headers, key=len, reverse=True))
+    return re.split(f'#({alternatives})#', template)
+
+def fill_template(compiled, recipient_data):
+    """
+    Renders a compiled template for a recipient in a single pass.
+
+    Parameters:
+    compiled (list): Template compiled by compile_template.
+    recipient_data (dict): Recipient data containing values for each placeholder.
+
+    Returns:
+    str: Rendered template.
+    """
+    parts = compiled.copy()
+    parts[1::2] = [recipient_data[header] for header in compiled[1::2]]
+    return ''.join(parts)
+
+def fill_template_columns(compiled, columns):
+    """
+    Renders a compiled template for every recipient, one column at a time.
+
+    Parameters:
+    compiled (list): Template compiled by compile_template.
+    columns (dict): List of values of each placeholder, one value per recipient.
+
+    Returns:
+    list[str]: Rendered template for each recipient, in order.
+    """
+    if len(compiled) == 1:
+        return [compiled[0]] * len(columns['email'])
+    parts = [repeat(chunk) if i % 2 == 0 else columns[chunk] for i, chunk in enumerate(compiled)]
+    return list(map(''.join, zip(*parts)))
+
+def render_columns(compiled_subject, compiled_body, columns, hashes=None, render_bodies=True):
+    """
+    Renders subject and body of every recipient, and attaches 1x1 transparent images for view tracking if given hashes.
+    Module level so that it can be run by a process pool on shards of recipients.
+
+    Parameters:
+    compiled_subject (list): Subject template compiled by compile_template.
+    compiled_body (list): Body template compiled by compile_template.
+    columns (dict): List of values of email and each placeholder, one value per recipient.
+    hashes (list[str]): Unique id of each recipient's email, used in its tracking image. None to not attach images.
+    render_bodies (bool): Whether to render bodies. If not, only subjects are rendered (and sent back by the pool).
+
+    Returns:
+    list[str], list[str], list[str]: Subjects, bodies and bodies to send (with images attached).
+                                     Bodies are None if not rendered.
+    """
+    subjects = fill_template_columns(compiled_subject, columns)
+    if not render_bodies:
+        return subjects, None, None
+    bodies = fill_template_columns(compiled_body, columns)
+    if hashes is None:
+        return subjects, bodies, bodies
+    image_links = make_image_links(hashes)
+    sent_bodies = [attach_transparent_image(body, link) for body, link in zip(bodies, image_links)]
+    return subjects, bodies, sent_bodies
+
 class Parser:
     """
     Parser class to parse, prepare and track mail data.
@@ -17,11 +165,19 @@ class Parser:
     mail_data_path (str): Path to mail data CSV file.
     mail_body_path (str): Path to mail body txt file.
     report (dict): Dictionary storing number of emails sent to each department.
-    mail_data_df (pd.df): Dataframe containing mail data.
+    chunk_size (int): Number of rows read at a time in streaming mode. None to read the whole file at once.
+    mail_data_df (pd.df): Dataframe containing mail data. None in streaming mode.
+    columns (list): All columns of mail data, in file order.
+    layout (dict): Position of each column in the values of prepared emails.
     headers (list): All headers specified by user. Must be at most 5. Must include name and department.
     departments (set): Set of all unique departments.
+    department_counts (dict): Number of recipients in each department.
+    department_index (dict): Row positions of each department's recipients in mail_data_df. None in streaming mode.
+    invalid_emails (list): Line number and email address of every invalid row found while validating.
     subject (str): Mail subject template.
     body (str): Mail body template.
+    compiled_subject (list): Subject template compiled into literal chunks and placeholder slots.
+    compiled_body (list): Body template compiled into literal chunks and placeholder slots.
 
     Mail data csv headers: email, name, department
 
@@ -34,116 +190,251 @@ class Parser:
     parser.update_report_data(emails)
     report = parser.prepare_report()
     print(report)
+
+    Streaming usage (memory stays flat regardless of file size):
+    parser = Parser('data.csv', 'body.txt', chunk_size=50000)
+    for emails_df in parser.iter_email_frames('department-A5'):
+        # send emails in emails_df
     """
-    def __init__(self, mail_data_path, mail_body_path):
+    def __init__(self, mail_data_path, mail_body_path, chunk_size=None):
         self.mail_data_path = mail_data_path
         self.mail_body_path = mail_body_path
+        self.chunk_size = chunk_size
         self.report = {}
         self.headers = []
+        self.columns = []
+        self.layout = {}
+        self.departments = set()
+        self.department_counts = {}
+        self.department_index = None
+        self.invalid_emails = []
+
+        # 1. Read and validate mail data
+        if chunk_size:
+            # Streaming mode: validate every chunk now, but only keep what is needed to prepare emails later
+            self.mail_data_df = None
+            for _ in self._iter_mail_data():
+                pass
+        else:
+            self.mail_data_df = next(self._iter_mail_data())
+            # Positions of each department's recipients, so that filtering only touches the selected rows
+            self.department_index = self.mail_data_df.groupby('department', sort=True).indices
+
+        # Report every invalid email address at once, rather than only the first one
+        if self.invalid_emails:
+            raise Invalid_Emails_Error(self.invalid_emails)
+
+        # 2. Read mail body
+        try:
+            with open(self.mail_body_path, 'r') as file:
+                file_content = file.read().split('\n\n', 1)
+                if len(file_content) < 2:
+                    raise ValueError(f"{os.path.basename(self.mail_body_path)} must contain subject and body separated by empty line")
+                if not file_content[1]:
+                    raise ValueError("Email body must not be empty.")
+                
+        except Exception as e:
+            raise Exception(f"An unexpected error occurred while reading mail body txt file: {e}")
+
+        self.subject = file_content[0]
+        self.body = file_content[1]
+
+        # 3. Compile templates once so that each email is rendered in a single pass
+        self.compiled_subject = compile_template(self.subject, self.headers)
+        self.compiled_body = compile_template(self.body, self.headers)
+        # Keys the hashes of emails, so that the same recipient gets a different hash for another template
+        self.template_digest = hashlib.md5((self.subject + '\n\n' + self.body).encode()).digest()
+    
+    def _read_mail_data(self):
+        """
+        Reads mail data CSV file, in chunks of at most chunk_size rows if streaming.
 
-        # 1. Read mail data
+        Yields:
+        pd.df: Dataframe containing (a chunk of) mail data.
+        """
         try:
-            mail_data_df = pd.read_csv(self.mail_data_path, dtype=str)
+            if not self.chunk_size:
+                yield pd.read_csv(self.mail_data_path, dtype=str)
+                return
+            with pd.read_csv(self.mail_data_path, dtype=str, chunksize=self.chunk_size) as reader:
+                yield from reader
         except pd.errors.EmptyDataError:
-            raise Exception(f"{self.mail_data_path.replace('uploads/', '')} must not be empty.")
+            raise Exception(f"{os.path.basename(self.mail_data_path)} must not be empty.")
         except pd.errors.ParserError as e:
-            raise Exception(f"Parsing error: {e}. Please fix {self.mail_data_path.replace('uploads/', '')} acordingly.")
+            raise Exception(f"Parsing error: {e}. Please fix {os.path.basename(self.mail_data_path)} acordingly.")
         except Exception as e:
             raise Exception(f"An unexpected error occurred while reading mail data csv file: {e}")
-        
+
+    def _validate_headers(self, mail_data_df):
+        """
+        Checks the columns of mail data and stores the headers (i.e. placeholders).
+
+        Parameters:
+        mail_data_df (pd.df): Dataframe containing (the first chunk of) mail data.
+        """
         # 1.1. Check for required columns
         required_fields = ['email', 'name', 'department']
         if not all(col in mail_data_df.columns for col in required_fields):
             raise ValueError("Mail Data CSV must be a csv file containing at least 'email', 'name', and 'department' columns")
-        if mail_data_df.isna().any().any():
-            raise ValueError("Mail Data CSV must not contain empty values")
-
-        self.mail_data_df = mail_data_df.drop_duplicates()
 
         # 1.2 Check for optional fields
-        headers = self.mail_data_df.columns.tolist()
+        headers = mail_data_df.columns.tolist()
         if len(headers) - 3 > 3:
             raise ValueError("There should be at most 5 email fields (i.e. placeholders) including 'name' and 'department' in Mail Data CSV")
-        with open(mail_data_path, 'r') as file:
+        with open(self.mail_data_path, 'r') as file:
             headers_temp = file.readline().strip().split(",")
         if len(headers_temp) != len(set(headers_temp)):
             raise ValueError("All email fields should be unique in Mail Data CSV")
+        self.columns = headers.copy()
+        # Position of each column in the values of prepared emails, shared by all of them
+        self.layout = {column: i for i, column in enumerate(self.columns)}
         headers.remove('email')
         self.headers = headers
 
+    def _validate_rows(self, mail_data_df):
+        """
+        Checks the rows of mail data and collates all departments.
+
+        Parameters:
+        mail_data_df (pd.df): Dataframe containing (a chunk of) deduplicated mail data.
+        """
         # 1.3. Collate all departments
-        departments = []
-        for department in self.mail_data_df['department']:
-            departments.append(department)
-        departments.sort()
-        self.departments = set(departments)
+        for department, count in mail_data_df['department'].value_counts().items():
+            self.department_counts[department] = self.department_counts.get(department, 0) + int(count)
+        self.departments.update(self.department_counts)
 
         if "all" in self.departments:
             raise ValueError("Mail Data CSV must not contain a department code named 'all'")
 
         # 1.4. Check for email address validity
-        for email in self.mail_data_df['email']:
-            if re.match(EMAIL_REGEX, email) is None:
-                raise ValueError(f"At least one email address: '{email}' does not follow the RFC 5322 and 1034 format")
+        self.invalid_emails.extend(find_invalid_emails(mail_data_df['email']))
 
-        # 2. Read mail body
-        try:
-            with open(self.mail_body_path, 'r') as file:
-                file_content = file.read().split('\n\n', 1)
-                if len(file_content) < 2:
-                    raise ValueError(f"{self.mail_body_path.replace('uploads/', '')} must contain subject and body separated by empty line")
-                if not file_content[1]:
-                    raise ValueError("Email body must not be empty.")
-                
-        except Exception as e:
-            raise Exception(f"An unexpected error occurred while reading mail body txt file: {e}")
+    @staticmethod
+    def _drop_seen_rows(mail_data_df, seen_digests):
+        """
+        Drops rows already seen in previous chunks, using compact 64-bit row digests.
 
-        self.subject = file_content[0]
-        self.body = file_content[1]
-    
-    def _filter_by_department(self, department='all'):
+        Parameters:
+        mail_data_df (pd.df): Dataframe containing a chunk of mail data, without duplicates within the chunk.
+        seen_digests (np.ndarray): Sorted digests of all rows in previous chunks.
+
+        Returns:
+        pd.df, np.ndarray: Chunk without previously seen rows, and the updated sorted digests.
+        """
+        digests = pd.util.hash_pandas_object(mail_data_df, index=False).to_numpy()
+        is_new = ~np.isin(digests, seen_digests, assume_unique=True)
+        return mail_data_df[is_new], np.union1d(seen_digests, digests[is_new])
+
+    def _iter_mail_data(self, validate=True):
+        """
+        Reads mail data, then validates and removes duplicates from it chunk by chunk.
+        Yields the whole mail data as a single dataframe if not streaming.
+
+        Parameters:
+        validate (bool): Whether to validate rows and collate departments. Only needed on the first pass.
+
+        Yields:
+        pd.df: Dataframe containing (a chunk of) validated mail data.
+        """
+        seen_digests = np.empty(0, dtype=np.uint64)
+        for i, mail_data_df in enumerate(self._read_mail_data()):
+            if i == 0:
+                self._validate_headers(mail_data_df)
+            if mail_data_df.isna().any().any():
+                raise ValueError("Mail Data CSV must not contain empty values")
+
+            mail_data_df = mail_data_df.drop_duplicates()
+            if self.chunk_size:
+                mail_data_df, seen_digests = self._drop_seen_rows(mail_data_df, seen_digests)
+
+            if validate:
+                self._validate_rows(mail_data_df)
+            yield mail_data_df
+
+    def _filter_by_department(self, department='all', mail_data_df=None):
         """
         Filters mail_data df by given department.
         
         Parameters:
-        mail_data_df (pd.df): DataFrame containing emails, names and departments (and optional headers).
         department (str): Department code to filter by.
+        mail_data_df (pd.df): DataFrame containing emails, names and departments (and optional headers).
+                              Defaults to all mail data.
 
         Returns:
         pd.df: Filtered dataframe containing recipients from given department.
         """
         if department.lower() == 'all':
-            return self.mail_data_df
-        return self.mail_data_df[self.mail_data_df['department'] == department]
+            return self.mail_data_df if mail_data_df is None else mail_data_df
+        if mail_data_df is None:
+            return self.mail_data_df.iloc[self.department_index.get(department, [])]
+        return mail_data_df[mail_data_df['department'] == department]
+
+    def _iter_filtered_mail_data(self, department='all'):
+        """
+        Filters mail data by given department, chunk by chunk if streaming.
+
+        Parameters:
+        department (str): Department code to filter by.
+
+        Yields:
+        pd.df: Non-empty dataframe containing (a chunk of) recipients from given department.
+        """
+        if not self.chunk_size:
+            mail_data_df = self._filter_by_department(department)
+            if not mail_data_df.empty:
+                yield mail_data_df
+            return
+
+        for mail_data_df in self._iter_mail_data(validate=False):
+            mail_data_df = self._filter_by_department(department, mail_data_df)
+            if not mail_data_df.empty:
+                yield mail_data_df
+
+    def _iter_render_chunks(self, department='all'):
+        """
+        Filters mail data by given department, in chunks of at most RENDER_CHUNK_ROWS recipients.
+
+        Parameters:
+        department (str): Department code to filter by.
+
+        Yields:
+        pd.df: Non-empty dataframe containing a chunk of recipients from given department.
+        """
+        for mail_data_df in self._iter_filtered_mail_data(department):
+            for start in range(0, len(mail_data_df), RENDER_CHUNK_ROWS):
+                yield mail_data_df.iloc[start:start + RENDER_CHUNK_ROWS]
+
+    def _hash_emails(self, mail_data_df):
+        """
+        Derives the hash (i.e. unique tracking id) of each recipient's email from their row of mail data and the
+        templates, so that emails can be tracked without rendering them. Each 16-byte digest is made of two 64-bit
+        row hashes, keyed by halves of the template digest.
+
+        Parameters:
+        mail_data_df (pd.df): Dataframe containing (a chunk of) recipients.
+
+        Returns:
+        list[bytes]: 16-byte digest of each recipient's email, in order.
+        """
+        key = self.template_digest.hex()
+        rows = mail_data_df[self.columns]
+        halves = [pd.util.hash_pandas_object(rows, index=False, hash_key=key[i:i + 16]).to_numpy() for i in (0, 16)]
+        digests = np.column_stack(halves).astype('>u8').tobytes()
+        return [digests[i:i + 16] for i in range(0, len(digests), 16)]
 
     def _prepare_email_content(self, recipient_data):
         """
         Prepares email subject and body for given recipient.
         
         Parameters:
-        template_subject (str): Subject of email template.
-        template_body (str): Body of email template.
         recipient_data (dict): Recipient data containing name, email and department (and optional headers).
 
         Returns:
         str, str: Subject and body of email template.
         """
-        subject = self.subject
-        body = self.body
-
-        for header in self.headers:
-            subject = subject.replace('#' + header + '#', recipient_data[header])
-            body = body.replace('#' + header + '#', recipient_data[header])
-
-        md5_hash = hashlib.md5((recipient_data['email'] + subject + body).encode()).hexdigest()
-        return subject, body, md5_hash
-
-    def _attach_transparent_images(self, emails):
-        hashes = [email['hash'] for email in emails]
-        image_links = asyncio.run(make_image_links(hashes))
-
-        for i in range(len(emails)):
-            emails[i]['body'] = emails[i]['body'].replace('</body>', f'<img src="{image_links[i]}"></body>', 1)
+        subject = fill_template(self.compiled_subject, recipient_data)
+        body = fill_template(self.compiled_body, recipient_data)
+        return subject, body
 
     def prepare_first_email(self, department='all'):
         """
@@ -154,57 +445,225 @@ class Parser:
         department (str): Department code to filter by.
 
         Returns:
-        dict with email, name, department, subject and body
+        Prepared_Email with email, name, department, subject and body
         """
         # 1. Filter by department code
-        filtered_mail_data_df = self._filter_by_department(department)
-        email = filtered_mail_data_df.to_dict(orient='records')[0]
+        filtered_mail_data_df = next(self._iter_filtered_mail_data(department), None)
+        if filtered_mail_data_df is None:
+            raise ValueError("There are no recipients to prepare an email for.")
+        first_df = filtered_mail_data_df.iloc[:1]
+        values = next(first_df[self.columns].itertuples(index=False, name=None))
 
         # 2. Prepare email
-        subject, body, md5_hash = self._prepare_email_content(email)
-        email['subject'] = subject
-        email['body'] = body
-        email['body_view'] = body
-        email['hash'] = md5_hash
-        email['id'] = str(0)
+        subject, body = self._prepare_email_content(dict(zip(self.columns, values)))
+        return Prepared_Email(self.layout, values, subject, body, self._hash_emails(first_df)[0], 0, tracked=False)
 
-        return email
+    def _render_columns_in_parallel(self, columns, hashes, workers, render_bodies=True):
+        """
+        Shards recipients across the shared render pool, rendering each shard with render_columns.
+        Only the columns used by the templates are sent to the workers, and only what is rendered is sent back.
+        Falls back to rendering in this process if the pool is broken.
 
-    def prepare_all_emails(self, department='all', attach_transparent_images=True):
+        Returns:
+        list[str], list[str], list[str]: Subjects, bodies and bodies to send, in recipient order.
+                                         Bodies are None if not rendered.
         """
-        Prepares email subject and body for all recipients in string format.
-        
+        bounds = np.linspace(0, len(columns['email']), workers + 1).astype(int)
+        shards = [{name: values[start:end] for name, values in columns.items()}
+                  for start, end in zip(bounds[:-1], bounds[1:])]
+        hash_shards = [None if hashes is None else hashes[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        merged = ([], [], [])
+        pool = get_render_pool()
+        try:
+            for rendered in pool.map(render_columns, repeat(self.compiled_subject), repeat(self.compiled_body),
+                                     shards, hash_shards, repeat(render_bodies)):
+                for merged_column, column in zip(merged, rendered):
+                    if column is not None:
+                        merged_column.extend(column)
+        except BrokenProcessPool:
+            _discard_render_pool(pool)
+            return render_columns(self.compiled_subject, self.compiled_body, columns, hashes, render_bodies)
+        if not render_bodies:
+            return merged[0], None, None
+        return merged
+
+    def _render_columns(self, mail_data_df, hashes=None, workers=None, render_bodies=True):
+        """
+        Renders subject and body of every recipient of a dataframe, column by column.
+
+        Parameters:
+        mail_data_df (pd.df): Dataframe containing (a chunk of) recipients.
+        hashes (list[str]): Hash of each recipient's email, to attach 1x1 transparent images for view tracking with.
+                            None to not attach them.
+        workers (int): Number of processes to render with. Defaults to RENDER_WORKERS for large campaigns, 1 otherwise.
+        render_bodies (bool): Whether to render bodies, or only subjects.
+
+        Returns:
+        list[str], list[str], list[str]: Subjects, bodies and bodies to send, in recipient order.
+                                         Bodies are None if not rendered.
+        """
+        if workers is None:
+            workers = RENDER_WORKERS if len(mail_data_df) >= PARALLEL_RENDER_MIN_ROWS else 1
+
+        used_columns = {'email'} | set(self.compiled_subject[1::2])
+        if render_bodies:
+            used_columns |= set(self.compiled_body[1::2])
+        columns = {name: mail_data_df[name].tolist() for name in used_columns}
+        if workers > 1:
+            return self._render_columns_in_parallel(columns, hashes, workers, render_bodies)
+        return render_columns(self.compiled_subject, self.compiled_body, columns, hashes, render_bodies)
+
+    def _render_email_frame(self, mail_data_df, first_id=0, attach_transparent_images=True, workers=None):
+        """
+        Prepares email subject and body for all recipients of a dataframe as columns.
+        Placeholders are substituted column by column rather than row by row.
+
+        Parameters:
+        mail_data_df (pd.df): Dataframe containing (a chunk of) recipients.
+        first_id (int): Id of the first recipient in the dataframe.
+        attach_transparent_images (bool): Whether to attach 1x1 transparent images for view tracking.
+        workers (int): Number of processes to render with. Defaults to RENDER_WORKERS for large campaigns, 1 otherwise.
+
+        Returns:
+        pd.df: Dataframe with email, name, department (and optional headers), subject, body, body_view, hash and id columns.
+        """
+        emails_df = mail_data_df.reset_index(drop=True)
+        hashes = [digest.hex() for digest in self._hash_emails(emails_df)]
+        subjects, bodies, sent_bodies = self._render_columns(emails_df, hashes if attach_transparent_images else None,
+                                                             workers)
+        return emails_df.assign(subject=subjects, body=sent_bodies, body_view=bodies, hash=hashes,
+                                id=np.arange(first_id, first_id + len(emails_df)).astype(str))
+
+    def iter_email_frames(self, department='all', attach_transparent_images=True, workers=None):
+        """
+        Prepares email subject and body for all recipients, one chunk of at most RENDER_CHUNK_ROWS
+        (and chunk_size if streaming) recipients at a time.
+
         Parameters:
         department (str): Department code to filter by.
+        attach_transparent_images (bool): Whether to attach 1x1 transparent images for view tracking.
+        workers (int): Number of processes to render with. Defaults to RENDER_WORKERS for large campaigns, 1 otherwise.
+
+        Yields:
+        pd.df: Dataframe with email, name, department (and optional headers), subject, body, body_view, hash and id columns.
+        """
+        first_id = 0
+        for mail_data_df in self._iter_render_chunks(department):
+            yield self._render_email_frame(mail_data_df, first_id, attach_transparent_images, workers)
+            first_id += len(mail_data_df)
+
+    def prepare_email_frame(self, department='all', attach_transparent_images=True, workers=None):
+        """
+        Prepares email subject and body for all recipients as columns of a single dataframe.
+        Not available in streaming mode, as the whole campaign would be held in memory. Use iter_email_frames instead.
+
+        Parameters:
+        department (str): Department code to filter by.
+        attach_transparent_images (bool): Whether to attach 1x1 transparent images for view tracking.
+        workers (int): Number of processes to render with. Defaults to RENDER_WORKERS for large campaigns, 1 otherwise.
 
         Returns:
-        list of dicts, each dict with email, name, department, subject and body
+        pd.df: Dataframe with email, name, department (and optional headers), subject, body, body_view, hash and id columns.
         """
-        # 1. Filter by department code
-        filtered_mail_data_df = self._filter_by_department(department)
-        emails = filtered_mail_data_df.to_dict(orient='records')
-
-        # 2. Prepare all emails
-        for i in range(len(emails)):
-            subject, body, md5_hash = self._prepare_email_content(emails[i])
-            emails[i]['subject'] = subject
-            emails[i]['body'] = body
-            emails[i]['body_view'] = body
-            emails[i]['hash'] = md5_hash
-            emails[i]['id'] = str(i)
+        if self.chunk_size:
+            raise ValueError("Emails of a streaming parser must be prepared chunk by chunk with iter_email_frames")
+        return self._render_email_frame(self._filter_by_department(department), 0, attach_transparent_images, workers)
+
+    def prepare_all_emails(self, department='all', attach_transparent_images=True, workers=None, keep_bodies=True):
+        """
+        Prepares email subject and body for all recipients in string format, rendering them chunk by chunk.
         
-        # 3. Attach 1x1 transparent images
-        if attach_transparent_images:
-            self._attach_transparent_images(emails)
+        Parameters:
+        department (str): Department code to filter by.
+        attach_transparent_images (bool): Whether to attach 1x1 transparent images for view tracking.
+        workers (int): Number of processes to render with. Defaults to RENDER_WORKERS for large campaigns, 1 otherwise.
+        keep_bodies (bool): Whether to keep the rendered body of each email. If not, body_view and body are None,
+                            and the body of an email is rendered again with render_body_view() when needed.
 
+        Returns:
+        list of Prepared_Email, each with email, name, department (and optional headers), subject, body, body_view, hash and id
+        """
+        emails = []
+        email_id = 0
+        for mail_data_df in self._iter_render_chunks(department):
+            # Bodies to send are derived from body_view when needed, so they are not rendered here.
+            # Bodies not kept are not rendered at all, nor copied back from the render pool.
+            subjects, bodies, _ = self._render_columns(mail_data_df, None, workers, render_bodies=keep_bodies)
+            if not keep_bodies:
+                bodies = repeat(None)
+            rows = mail_data_df[self.columns].itertuples(index=False, name=None)
+            emails += [Prepared_Email(self.layout, values, subject, body_view, digest, email_id + i,
+                                      attach_transparent_images)
+                       for i, (values, subject, body_view, digest)
+                       in enumerate(zip(rows, subjects, bodies, self._hash_emails(mail_data_df)))]
+            email_id += len(mail_data_df)
         return emails
 
+    def render_body_view(self, email):
+        """
+        Renders the body of a prepared email, without the tracking image, e.g. if it was prepared without keeping it.
+
+        Parameters:
+        email (Prepared_Email): Email prepared by this parser.
+
+        Returns:
+        str: Body of the email.
+        """
+        return fill_template(self.compiled_body, email)
+
+    def iter_emails(self, department='all', attach_transparent_images=True, first_id=0):
+        """
+        Prepares email subject and body for each recipient only when it is requested.
+        Memory used does not grow with the number of recipients, so this is suited for sending.
+
+        Parameters:
+        department (str): Department code to filter by.
+        attach_transparent_images (bool): Whether to attach 1x1 transparent images for view tracking.
+        first_id (int): Id of the first email to prepare. Earlier recipients are skipped without being prepared.
+
+        Yields:
+        Prepared_Email with email, name, department (and optional headers), subject, body, body_view, hash and id.
+        """
+        email_id = 0
+        for mail_data_df in self._iter_render_chunks(department):
+            if email_id + len(mail_data_df) <= first_id:
+                email_id += len(mail_data_df)
+                continue
+            mail_data_df = mail_data_df.iloc[max(first_id - email_id, 0):]
+            email_id = max(email_id, first_id)
+            rows = mail_data_df[self.columns].itertuples(index=False, name=None)
+            for values, digest in zip(rows, self._hash_emails(mail_data_df)):
+                subject, body = self._prepare_email_content(dict(zip(self.columns, values)))
+                yield Prepared_Email(self.layout, values, subject, body, digest, email_id, attach_transparent_images)
+                email_id += 1
+
+    def prepare_email_metadata(self, department='all'):
+        """
+        Prepares compact details of all recipients, without rendering their emails.
+        Hashes are derived from mail data, a chunk at a time.
+
+        Parameters:
+        department (str): Department code to filter by.
+
+        Returns:
+        list of Email_Metadata, each with email, department, hash and id
+        """
+        metadata = []
+        email_id = 0
+        for mail_data_df in self._iter_render_chunks(department):
+            metadata += [Email_Metadata(email, email_department, digest, email_id + i)
+                         for i, (email, email_department, digest)
+                         in enumerate(zip(mail_data_df['email'], mail_data_df['department'],
+                                          self._hash_emails(mail_data_df)))]
+            email_id += len(mail_data_df)
+        return metadata
+
     def update_report_data(self, emails):
         """
         Updates sent email counts in email report.
         
         Parameters:
-        emails: list of dicts, each dict with email, name, department, subject and body
+        emails: list of prepared emails, each with email, name, department, subject and body
         """
         for person in emails:
             if person['department'] not in self.report:
@@ -212,6 +671,26 @@ class Parser:
             else:
                 self.report[person['department']] += 1
 
+    def reset_report(self):
+        """
+        Clears sent email counts in email report, e.g. before reusing this parser for another batch.
+        """
+        self.report = {}
+
+    def update_report_counts(self, department='all'):
+        """
+        Updates sent email counts in email report using the number of recipients in each department.
+
+        Parameters:
+        department (str): Department code the emails were sent to.
+        """
+        if department.lower() == 'all':
+            counts = self.department_counts
+        else:
+            counts = {department: self.department_counts.get(department, 0)}
+        for department, count in counts.items():
+            self.report[department] = self.report.get(department, 0) + count
+
     def prepare_report(self):
         """
         Prepares email report as printable string.
@@ -0,0 +1,100 @@
+from image_link import make_image_links
+
+"""
+Attaches a 1x1 transparent image for view tracking to the end of an email body.
+Parameters:
+    body (str): Email body.
+    image_link (str): Unique link of the tracking image.
+Returns: (str): Email body with the image attached.
+"""
+def attach_transparent_image(body, image_link) -> str:
+    return body.replace('</body>', f'<img src="{image_link}"></body>', 1)
+
+"""
+Compact details of an email being sent, kept for viewing its send status and view count.
+Supports both attribute (email.hash) and item (email['hash']) access, like the dicts it replaces.
+The hash is stored as a 16-byte digest and the id as an int, and both are converted on access.
+"""
+class Email_Metadata:
+    __slots__ = ('email', 'department', '_digest', '_id')
+    KEYS = ('email', 'department', 'hash', 'id')
+
+    def __init__(self, email, department, digest, email_id):
+        self.email = email
+        self.department = department
+        self._digest = digest
+        self._id = email_id
+
+    """
+    Creates compact details from a mapping (e.g. dict) with email, department, hash (hex) and id.
+    """
+    @classmethod
+    def from_mapping(cls, email):
+        return cls(email['email'], email['department'], bytes.fromhex(email['hash']), int(email['id']))
+
+    @property
+    def hash(self):
+        return self._digest.hex()
+
+    @property
+    def id(self):
+        return str(self._id)
+
+    def keys(self):
+        return self.KEYS
+
+    def __getitem__(self, key):
+        if key not in self.keys():
+            raise KeyError(key)
+        return getattr(self, key)
+
+    """
+    Returns a dict with all keys of this email, e.g. for JSON serialization.
+    """
+    def to_dict(self):
+        return {key: self[key] for key in self.keys()}
+
+"""
+A prepared email, with the recipient's fields, rendered subject and body, hash and id.
+Replaces per-email dicts: fields are stored in a tuple indexed by a layout shared by all emails,
+and the body sent (with the tracking image attached) is derived from body_view when accessed
+instead of being stored next to it.
+"""
+class Prepared_Email(Email_Metadata):
+    __slots__ = ('_layout', '_values', 'subject', 'body_view', '_tracked')
+
+    def __init__(self, layout, values, subject, body_view, digest, email_id, tracked=True):
+        super().__init__(values[layout['email']], values[layout['department']], digest, email_id)
+        self._layout = layout
+        self._values = values
+        self.subject = subject
+        self.body_view = body_view
+        self._tracked = tracked
+
+    """
+    Body to be sent, with a 1x1 transparent image for view tracking attached if tracked.
+    """
+    @property
+    def body(self):
+        if not self._tracked:
+            return self.body_view
+        return attach_transparent_image(self.body_view, make_image_links([self.hash])[0])
+
+    def keys(self):
+        return (*self._layout, 'subject', 'body', 'body_view', 'hash', 'id')
+
+    def __getitem__(self, key):
+        if key in self._layout:
+            return self._values[self._layout[key]]
+        if key not in ('subject', 'body', 'body_view', 'hash', 'id'):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __getattr__(self, name):
+        # Only called for names that are not slots or properties, i.e. the recipient's fields
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._values[self._layout[name]]
+        except KeyError:
+            raise AttributeError(name)
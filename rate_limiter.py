@@ -0,0 +1,233 @@
+from threading import Lock
+import sqlite3
+import time
+
+# Sending quotas of each provider, as a sustained rate and the largest burst allowed at once.
+# These can be adjusted to match the quota of the account being used.
+RATE_PROFILES = {
+    "smtp_gmail":   {"per_minute": 20,  "burst": 20},  # Gmail SMTP (app password)
+    "smtp_outlook": {"per_minute": 30,  "burst": 30},  # Outlook SMTP, 30 messages per minute
+    "gmail_api":    {"per_minute": 120, "burst": 50},  # Gmail API, 100 quota units per send
+    "graph":        {"per_minute": 30,  "burst": 30},  # Microsoft Graph, 30 messages per minute per mailbox
+}
+DEFAULT_PROFILE = "smtp_gmail"
+# Waits up to this many seconds for other processes to release a shared rate limit database
+BUSY_TIMEOUT = 30
+# Result of an email that was sent successfully
+SENT = "✓"
+# Adaptive rate: throttling multiplies the rate by DECREASE_FACTOR, at most once every DECREASE_INTERVAL seconds and
+# down to MIN_RATE_FRACTION of the quota. Each minute of successful sends adds INCREASE_FRACTION of the quota back.
+DECREASE_FACTOR = 0.5
+DECREASE_INTERVAL = 10
+MIN_RATE_FRACTION = 0.05
+INCREASE_FRACTION = 0.1
+# Latency is averaged with this weight for new samples, and counts as congestion once above LATENCY_FACTOR times
+# its usual value (and MIN_CONGESTED_LATENCY seconds). The usual value rises with this weight, so that it follows
+# lasting changes.
+LATENCY_SMOOTHING = 0.2
+BASE_LATENCY_SMOOTHING = 0.01
+LATENCY_FACTOR = 2
+MIN_CONGESTED_LATENCY = 1
+
+"""
+Token bucket rate limiter, which adapts its rate to feedback from the email server (AIMD).
+Tokens are refilled continuously at the current rate, up to burst tokens.
+Sending an email takes one token, so up to burst emails can be sent at once after being idle.
+
+The rate starts at the account's quota. Throttling replies (e.g. SMTP 421/451, HTTP 429) and rising latency
+halve it (down to MIN_RATE_FRACTION of the quota) and empty the bucket, and a Retry-After pauses sending for as
+long as asked. Each minute of successful sends raises it again by INCREASE_FRACTION of the quota.
+"""
+class Token_Bucket:
+    def __init__(self, per_minute, burst, profile=None):
+        self.profile = profile
+        self.max_rate = per_minute / 60
+        self.min_rate = self.max_rate * MIN_RATE_FRACTION
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.decreased = 0 # When the rate was last decreased
+        self.latency = None # Moving average of seconds taken by each send, and its usual value when not congested
+        self.base_latency = None
+        self._updated = self._now() # Tokens are refilled from this time, which is in the future while paused
+        self._lock = Lock()
+
+    def _now(self):
+        return time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + max(now - self._updated, 0) * self.rate)
+        self._updated = max(self._updated, now)
+
+    """
+    Refills the bucket, and lets update change it, atomically.
+    Parameters:
+        update (function): Takes the current time, and changes the bucket. Its return value is returned.
+    """
+    def _update(self, update):
+        with self._lock:
+            now = self._now()
+            self._refill(now)
+            return update(now)
+
+    """
+    Takes up to count tokens, waiting until at least one is available.
+    Parameters:
+        count (int): Maximum number of tokens to take.
+        cancel (threading.Event): Stops waiting once set.
+    Returns: (int): Number of tokens taken. 0 if cancelled.
+    """
+    def acquire(self, count, cancel):
+        while not cancel.is_set():
+            def take(now):
+                if self.tokens < 1:
+                    return 0, self._updated - now + (1 - self.tokens) / self.rate
+                taken = min(count, int(self.tokens))
+                self.tokens -= taken
+                return taken, 0
+            taken, wait = self._update(take)
+            if taken:
+                return taken
+            cancel.wait(wait)
+        return 0
+
+    """
+    Takes up to count tokens without waiting.
+    Returns: (int): Number of tokens taken. 0 if none are available.
+    """
+    def try_acquire(self, count):
+        def take(now):
+            taken = min(count, int(self.tokens)) if self.tokens >= 1 else 0
+            self.tokens -= taken
+            return taken
+        return self._update(take)
+
+    """
+    Updates the moving average of latency with a new sample.
+    Returns: (bool): Whether latency has risen well above its usual value, i.e. the server is congested.
+    """
+    def _observe_latency(self, latency):
+        if latency is None:
+            return False
+        if self.latency is None:
+            self.latency = self.base_latency = latency
+            return False
+        self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+        # The usual latency follows drops at once, and rises only slowly
+        self.base_latency = min(self.latency, self.base_latency + BASE_LATENCY_SMOOTHING * (self.latency - self.base_latency))
+        return self.latency > max(self.base_latency * LATENCY_FACTOR, MIN_CONGESTED_LATENCY)
+
+    """
+    Adapts the rate to the results of emails sent in a single call.
+    Parameters:
+        results (list[str]): Result of each email. Throttling errors are Send_Errors with throttled set.
+        latency (float): Seconds the call took, if measured.
+    """
+    def feedback(self, results, latency=None):
+        throttled = [result for result in results if getattr(result, "throttled", False)]
+        retry_after = max((result.retry_after or 0 for result in throttled), default=0)
+        # Only "✓" is a success. Other results (e.g. "Unable to connect or login ...") are not evidence of capacity.
+        sent = sum(result == SENT for result in results)
+        def adapt(now):
+            congested = self._observe_latency(latency)
+            if throttled or congested:
+                # Several emails in flight are throttled at once, so the rate is only halved once per interval
+                if now - self.decreased >= DECREASE_INTERVAL:
+                    self.rate = max(self.rate * DECREASE_FACTOR, self.min_rate)
+                    self.decreased = now
+                    self.tokens = min(self.tokens, 0)
+                if retry_after:
+                    self.tokens = min(self.tokens, 0)
+                    self._updated = max(self._updated, now + retry_after)
+            elif sent:
+                self.rate = min(self.rate + self.max_rate * INCREASE_FRACTION * sent / (self.rate * 60), self.max_rate)
+        self._update(adapt)
+
+    """
+    Returns the current state of this rate limiter, including how far it has backed off from the account's quota.
+    """
+    def state(self) -> dict:
+        def read(now):
+            return {"profile": self.profile,
+                    "per_minute": self.rate * 60,
+                    "max_per_minute": self.max_rate * 60,
+                    "burst": self.burst,
+                    "tokens": self.tokens,
+                    "next_token_in": max(self._updated - now, 0) + (0 if self.tokens >= 1 else (1 - self.tokens) / self.rate),
+                    "backing_off": self.rate < self.max_rate,
+                    "paused_for": max(self._updated - now, 0),
+                    "latency": self.latency,
+                    "base_latency": self.base_latency}
+        return self._update(read)
+
+"""
+Token bucket rate limiter shared by every process using the same SQLite database, e.g. several workers
+sending from the same account. The bucket (including its adapted rate) is stored in the database and updated
+in a write transaction, so processes take tokens one at a time, and back off together.
+Uses wall clock time, as it is compared across processes.
+"""
+class Shared_Token_Bucket(Token_Bucket):
+    def __init__(self, path, key, per_minute, burst, profile=None):
+        super().__init__(per_minute, burst, profile)
+        self.path = path
+        self.key = key
+        self._db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+                         "updated REAL NOT NULL, rate REAL, decreased REAL) WITHOUT ROWID")
+        # Databases created before rates were adapted have no rate or decreased columns
+        columns = [column[1] for column in self._db.execute("PRAGMA table_info(rate_limits)")]
+        for column in ("rate", "decreased"):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE rate_limits ADD COLUMN {column} REAL")
+
+    def _now(self):
+        return time.time()
+
+    """
+    Loads the bucket, refills it, lets update change it and stores it, in a single transaction.
+    """
+    def _update(self, update):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute("SELECT tokens, updated, rate, decreased FROM rate_limits WHERE key = ?",
+                                       (self.key,)).fetchone()
+                now = self._now()
+                if row:
+                    self.tokens, self._updated, rate, decreased = row
+                    self.rate = min(max(rate or self.max_rate, self.min_rate), self.max_rate)
+                    self.decreased = decreased or 0
+                else:
+                    self.tokens, self._updated, self.rate = self.burst, now, self.max_rate
+                self._refill(now)
+                result = update(now)
+                self._db.execute("INSERT OR REPLACE INTO rate_limits (key, tokens, updated, rate, decreased) "
+                                 "VALUES (?, ?, ?, ?, ?)", (self.key, self.tokens, self._updated, self.rate, self.decreased))
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+_limiters = {}
+_limiters_lock = Lock()
+
+"""
+Returns the rate limiter of the user's account, shared by everything sending from that account.
+Parameters:
+    user (User): The user object that will send the emails.
+    shared_path (str): Path of a SQLite database to share the rate limit with other processes through.
+                       None to only share it within this process.
+"""
+def get_rate_limiter(user, shared_path=None) -> Token_Bucket:
+    with _limiters_lock:
+        key = (user.get_id(), shared_path)
+        if key not in _limiters:
+            profile = user.rate_profile or DEFAULT_PROFILE
+            if shared_path:
+                _limiters[key] = Shared_Token_Bucket(shared_path, user.get_id(), **RATE_PROFILES[profile],
+                                                     profile=profile)
+            else:
+                _limiters[key] = Token_Bucket(**RATE_PROFILES[profile], profile=profile)
+        return _limiters[key]
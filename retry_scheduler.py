@@ -0,0 +1,177 @@
+from email.utils import parsedate_to_datetime
+from threading import Lock
+import smtplib
+import random
+import heapq
+import time
+
+# Emails failing with a transient error are sent up to MAX_SEND_ATTEMPTS times in total, waiting
+# RETRY_BASE * 2^(attempt - 1) + [0, RETRY_BASE) seconds (at most RETRY_MAX_DELAY) before each retry,
+# or as long as the server asked for with Retry-After if longer
+MAX_SEND_ATTEMPTS = 4
+RETRY_BASE = 2
+RETRY_MAX_DELAY = 300
+# HTTP statuses worth retrying: timeouts, throttling and server errors
+TRANSIENT_HTTP_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# Replies meaning the account is sending too fast, which slow down the rate of sending (see rate_limiter.py)
+THROTTLING_SMTP_CODES = {421, 451}
+THROTTLING_HTTP_STATUSES = {429, 503}
+
+"""
+Result of an email that failed to send. Is a str ("Error: ..."), so it can be stored and shown like any other result,
+and also records whether the failure is transient (i.e. the email may be sent if retried later).
+Parameters:
+    message (str): Error message shown as the email's result.
+    transient (bool): Whether sending again later may succeed.
+    retry_after (float): Seconds the server asked to wait before sending again, if any.
+    throttled (bool): Whether the server refused the email because the account is sending too fast.
+"""
+class Send_Error(str):
+    def __new__(cls, message, transient=False, retry_after=None, throttled=False):
+        error = super().__new__(cls, message)
+        error.transient = transient
+        error.retry_after = retry_after
+        error.throttled = throttled
+        return error
+
+"""
+Returns the number of seconds to wait given by a Retry-After header (in seconds or as an HTTP date), or None.
+"""
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+"""
+Classifies an error raised while sending with SMTP.
+4xx replies (e.g. 421 service not available, 451 local error, 452 insufficient storage), dropped connections
+and network errors are transient. 5xx replies (e.g. 550 mailbox unavailable, 535 bad credentials) are permanent.
+Parameters:
+    err (Exception): The error raised.
+    message (str): Message of the result. Defaults to the error.
+Returns: (Send_Error): The classified error.
+"""
+def smtp_error(err, message=None) -> Send_Error:
+    message = message or "Error: " + str(err)
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in err.recipients.values()]
+        return Send_Error(message, transient=bool(codes) and all(400 <= code < 500 for code in codes),
+                          throttled=any(code in THROTTLING_SMTP_CODES for code in codes))
+    if isinstance(err, smtplib.SMTPResponseException):
+        return Send_Error(message, transient=400 <= err.smtp_code < 500,
+                          throttled=err.smtp_code in THROTTLING_SMTP_CODES)
+    # SMTP errors are OSErrors too, but only a dropped connection among them is transient
+    network_error = isinstance(err, OSError) and not isinstance(err, smtplib.SMTPException)
+    return Send_Error(message, transient=network_error or isinstance(err, smtplib.SMTPServerDisconnected))
+
+"""
+Classifies an HTTP error response of the Gmail API or Microsoft Graph.
+Parameters:
+    status (int): HTTP status of the response.
+    reason (str): Reason shown as the email's result.
+    retry_after (str): Retry-After header of the response, if any.
+Returns: (Send_Error): The classified error.
+"""
+def http_error(status, reason, retry_after=None) -> Send_Error:
+    return Send_Error("Error: " + reason, transient=status in TRANSIENT_HTTP_STATUSES or status >= 500,
+                      retry_after=parse_retry_after(retry_after), throttled=status in THROTTLING_HTTP_STATUSES)
+
+"""
+Returns whether a result is a failure that should be retried, given the number of attempts made so far.
+"""
+def should_retry(result, attempts, max_attempts=MAX_SEND_ATTEMPTS) -> bool:
+    return isinstance(result, Send_Error) and result.transient and attempts < max_attempts
+
+"""
+Returns the number of seconds to wait before the next attempt, with exponential backoff and jitter.
+Parameters:
+    attempts (int): Number of attempts made so far.
+    retry_after (float): Seconds the server asked to wait, if any.
+"""
+def retry_delay(attempts, retry_after=None, base=RETRY_BASE, max_delay=RETRY_MAX_DELAY) -> float:
+    delay = min(base * 2 ** (attempts - 1) + random.uniform(0, base), max_delay)
+    return max(delay, retry_after or 0)
+
+"""
+Schedules retries of emails that failed with a transient error, and keeps a dead-letter list of the emails
+that still failed after all attempts. Dead letters keep their prepared email, so they can be sent again later.
+
+Emails are identified by items of (email id, prepared email, error, number of attempts made so far).
+"""
+class Retry_Scheduler:
+    def __init__(self, max_attempts=MAX_SEND_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self._scheduled = [] # Heap of (due time, sequence number, item)
+        self._sequence = 0
+        self.dead_letters = [] # (email id, prepared email, error, attempts) of each email that ran out of attempts
+        self._lock = Lock()
+
+    """
+    Handles the result of an attempt to send an email.
+    Transient failures are scheduled to be retried, and moved to the dead-letter list once out of attempts.
+    Parameters:
+        item (tuple): The email sent, as (email id, prepared email, error, number of attempts before this one).
+        result (str): Result of sending the email.
+    Returns: (bool): Whether the result is final, i.e. the email will not be retried.
+    """
+    def handle_result(self, item, result) -> bool:
+        email_id, prepared, _, attempts = item
+        attempts += 1
+        with self._lock:
+            if should_retry(result, attempts, self.max_attempts):
+                due = time.monotonic() + retry_delay(attempts, result.retry_after)
+                heapq.heappush(self._scheduled, (due, self._sequence, (email_id, prepared, None, attempts)))
+                self._sequence += 1
+                return False
+            if isinstance(result, Send_Error) and result.transient:
+                self.dead_letters.append((email_id, prepared, result, attempts))
+            return True
+
+    """
+    Returns up to count emails whose retry is due, earliest first.
+    """
+    def pop_due(self, count) -> list[tuple]:
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._scheduled and len(due) < count and self._scheduled[0][0] <= now:
+                due.append(heapq.heappop(self._scheduled)[2])
+        return due
+
+    """
+    Returns the number of seconds until the next retry is due, or None if there are no retries scheduled.
+    """
+    def next_due_in(self):
+        with self._lock:
+            if not self._scheduled:
+                return None
+            return max(self._scheduled[0][0] - time.monotonic(), 0)
+
+    """
+    Drops all scheduled retries, e.g. when sending is cancelled.
+    """
+    def clear(self):
+        with self._lock:
+            self._scheduled = []
+
+    """
+    Removes and returns all dead letters, e.g. to send them again.
+    """
+    def take_dead_letters(self) -> list[tuple]:
+        with self._lock:
+            dead_letters, self.dead_letters = self.dead_letters, []
+            return dead_letters
+
+    """
+    Returns the number of scheduled retries and dead letters.
+    """
+    def state(self) -> dict:
+        with self._lock:
+            return {"retries_scheduled": len(self._scheduled), "dead_letters": len(self.dead_letters)}
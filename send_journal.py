@@ -0,0 +1,194 @@
+from threading import Thread, Lock, Event
+import sqlite3
+import atexit
+import json
+import time
+import uuid
+
+SEND_JOURNAL_PATH = "journal.db"
+# Results are buffered in memory and written in a single transaction every FLUSH_INTERVAL seconds,
+# or as soon as FLUSH_THRESHOLD results are pending
+FLUSH_INTERVAL = 1
+FLUSH_THRESHOLD = 500
+# A campaign is sent by the process that claimed it, which renews its claim every CLAIM_TIMEOUT / 3 seconds.
+# Other processes sharing the journal (e.g. several server processes) only resume it once the claim has expired.
+CLAIM_TIMEOUT = 30
+
+# States of a campaign in the journal. Only campaigns still sending are resumed on startup.
+SENDING = "sending"
+FINISHED = "finished"
+CANCELLED = "cancelled"
+ABANDONED = "abandoned"
+
+"""
+Persistent, append-only journal of sent emails, stored in SQLite (in WAL mode).
+Records the details needed to prepare a campaign's emails again, and the result of each email as it is sent,
+so that campaigns interrupted by a restart can be resumed from the first recipient without a result.
+
+Results are buffered and written in batches, so journaling does not slow down sending.
+Results not yet written when the process stops are lost, so their emails are sent again when resumed.
+
+Several processes can share the journal. Each campaign is claimed by the process sending it, so that a campaign
+is only resumed by a single process.
+"""
+class Send_Journal:
+    def __init__(self, path=SEND_JOURNAL_PATH, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.owner = uuid.uuid4().hex # Id of this journal's process in the claims of campaigns
+        self._claims_renewed = 0
+        self._pending = [] # (campaign id, email id, result) of results not written yet
+        self._pending_lock = Lock()
+        self._db_lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS campaigns (campaign_id TEXT PRIMARY KEY, user_id TEXT NOT NULL, "
+                         "details TEXT NOT NULL, state TEXT NOT NULL, owner TEXT, claimed_until REAL)")
+        # Journals created before campaigns were claimed have no owner or claimed_until columns
+        columns = [column[1] for column in self._db.execute("PRAGMA table_info(campaigns)")]
+        for column, column_type in (("owner", "TEXT"), ("claimed_until", "REAL")):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE campaigns ADD COLUMN {column} {column_type}")
+        self._db.execute("CREATE TABLE IF NOT EXISTS results (campaign_id TEXT NOT NULL, email_id INTEGER NOT NULL, "
+                         "result TEXT NOT NULL, PRIMARY KEY (campaign_id, email_id)) WITHOUT ROWID")
+        self._db.commit()
+
+        self._flush_now = Event()
+        self._closed = Event()
+        self._thread = Thread(target=self._flush_periodically, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _flush_periodically(self):
+        while not self._closed.is_set():
+            self._flush_now.wait(self.flush_interval)
+            self._flush_now.clear()
+            self.flush()
+            if time.time() - self._claims_renewed >= CLAIM_TIMEOUT / 3:
+                self.renew_claims()
+
+    """
+    Records that a campaign has started sending, claimed by this process.
+    Parameters:
+        campaign_id (str): Id of the campaign.
+        user_id (str): Id of the user sending the campaign.
+        details (dict): JSON serializable details needed to prepare the campaign's emails again.
+    """
+    def start_campaign(self, campaign_id, user_id, details):
+        with self._db_lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO campaigns (campaign_id, user_id, details, state, owner, claimed_until) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", (campaign_id, user_id, json.dumps(details), SENDING,
+                                                           self.owner, time.time() + CLAIM_TIMEOUT))
+
+    """
+    Claims a campaign that is still sending, so that this process can resume it.
+    The claim is made in a single statement, so only one of several processes sharing the journal succeeds.
+    Returns: (bool): Whether the campaign was claimed. False if it is claimed by another running process,
+                     or has stopped sending.
+    """
+    def claim_campaign(self, campaign_id) -> bool:
+        now = time.time()
+        with self._db_lock, self._db:
+            cursor = self._db.execute("UPDATE campaigns SET owner = ?, claimed_until = ? WHERE campaign_id = ? AND state = ? "
+                                      "AND (owner IS NULL OR owner = ? OR claimed_until < ?)",
+                                      (self.owner, now + CLAIM_TIMEOUT, campaign_id, SENDING, self.owner, now))
+            return cursor.rowcount == 1
+
+    """
+    Extends the claims of this process on the campaigns it is sending.
+    """
+    def renew_claims(self):
+        self._claims_renewed = time.time()
+        with self._db_lock, self._db:
+            self._db.execute("UPDATE campaigns SET claimed_until = ? WHERE owner = ? AND state = ?",
+                             (self._claims_renewed + CLAIM_TIMEOUT, self.owner, SENDING))
+
+    """
+    Returns the state of a campaign, or None if it is not in the journal.
+    """
+    def campaign_state(self, campaign_id):
+        with self._db_lock:
+            row = self._db.execute("SELECT state FROM campaigns WHERE campaign_id = ?", (campaign_id,)).fetchone()
+        return row[0] if row else None
+
+    """
+    Records the results of consecutive emails of a campaign. Written to the database in the next batch.
+    Parameters:
+        campaign_id (str): Id of the campaign.
+        first_id (int): Id of the first email.
+        results (list[str]): Result of each email, in order.
+    """
+    def record_results(self, campaign_id, first_id, results):
+        with self._pending_lock:
+            self._pending.extend((campaign_id, first_id + i, result) for i, result in enumerate(results))
+            if len(self._pending) >= FLUSH_THRESHOLD:
+                self._flush_now.set()
+
+    """
+    Writes all buffered results to the database in a single transaction.
+    """
+    def flush(self):
+        with self._db_lock, self._db:
+            with self._pending_lock:
+                pending, self._pending = self._pending, []
+            self._db.executemany("INSERT OR REPLACE INTO results (campaign_id, email_id, result) VALUES (?, ?, ?)",
+                                 pending)
+
+    """
+    Records that a campaign has stopped sending, after writing all of its buffered results.
+    Parameters:
+        campaign_id (str): Id of the campaign.
+        state (str): FINISHED, CANCELLED or ABANDONED.
+    """
+    def finish_campaign(self, campaign_id, state=FINISHED):
+        self.flush()
+        with self._db_lock, self._db:
+            self._db.execute("UPDATE campaigns SET state = ? WHERE campaign_id = ?", (state, campaign_id))
+
+    """
+    Returns (campaign id, user id, details) of every campaign that was still sending when the journal was last open.
+    """
+    def unfinished_campaigns(self) -> list[tuple[str, str, dict]]:
+        with self._db_lock:
+            rows = self._db.execute("SELECT campaign_id, user_id, details FROM campaigns WHERE state = ?",
+                                    (SENDING,)).fetchall()
+        return [(campaign_id, user_id, json.loads(details)) for campaign_id, user_id, details in rows]
+
+    """
+    Returns the results of a campaign's emails, up to the first email without a result.
+    """
+    def get_results(self, campaign_id) -> list[str]:
+        self.flush()
+        with self._db_lock:
+            rows = self._db.execute("SELECT email_id, result FROM results WHERE campaign_id = ? ORDER BY email_id",
+                                    (campaign_id,))
+            results = []
+            for email_id, result in rows:
+                if email_id != len(results):
+                    break
+                results.append(result)
+            return results
+
+    """
+    Removes a campaign and its results from the journal.
+    """
+    def forget(self, campaign_id):
+        self.flush()
+        with self._db_lock, self._db:
+            self._db.execute("DELETE FROM results WHERE campaign_id = ?", (campaign_id,))
+            self._db.execute("DELETE FROM campaigns WHERE campaign_id = ?", (campaign_id,))
+
+    """
+    Flushes buffered results and stops the background flushing.
+    Claims of this process are released, so that its campaigns can be resumed at once (e.g. after a reload).
+    """
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._flush_now.set()
+        self._thread.join()
+        self.flush()
+        with self._db_lock, self._db:
+            self._db.execute("UPDATE campaigns SET claimed_until = 0 WHERE owner = ?", (self.owner,))
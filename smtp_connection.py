@@ -1,5 +1,13 @@
 from parser import *
+from queue import LifoQueue
+from retry_scheduler import smtp_error
 import smtplib
+import time
+
+# Connections idle for longer than this are checked with NOOP before use, as servers drop idle connections
+KEEPALIVE_IDLE = 30
+# Attempts to send a message, reconnecting in between if the server has dropped the connection
+SEND_ATTEMPTS = 2
 
 class SMTP_Connection:
     """
@@ -26,27 +34,90 @@ class SMTP_Connection:
         self.user = user
         self.password = password
         self.smtp = None
+        self.last_used = 0
+        self.last_error = None
     
     def connect(self):
         """
         Establishes SMTP connection to given SMTP server.
         """
-        self.smtp = smtplib.SMTP(self.host, self.port)
-        if (self.port == 587):
-            self.smtp.starttls()
         try:
+            self.smtp = smtplib.SMTP(self.host, self.port)
+            if (self.port == 587):
+                self.smtp.starttls()
             self.smtp.login(self.user, self.password)
         except Exception as err:
+            self.close()
+            self.last_error = err
             return f'Unable to connect or login into {self.host} due to the following reason:\n{str(err)}.'
+        self.last_used = time.monotonic()
         return "Success"
+
+    def close(self):
+        """
+        Disconnects SMTP connection with mail server, even if the server has already dropped it.
+        """
+        if self.smtp:
+            try:
+                self.smtp.quit()
+            except Exception:
+                self.smtp.close()
+            self.smtp = None
+
+    def is_alive(self):
+        """
+        Checks whether the connection is still usable with a NOOP command.
+
+        Returns: (bool): True if the server replied to NOOP successfully.
+        """
+        if not self.smtp:
+            return False
+        try:
+            return self.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def ensure_connected(self):
+        """
+        Connects if not connected, or reconnects if the connection has been idle and is no longer alive.
+
+        Returns: (str): "Success", or the reason for failing to connect.
+        """
+        if self.smtp and (time.monotonic() - self.last_used < KEEPALIVE_IDLE or self.is_alive()):
+            return "Success"
+        self.close()
+        return self.connect()
     
     def __del__(self):
         """
         Disconnects SMTP connection with mail server
         """
-        if self.smtp:
-            self.smtp.quit()
+        self.close()
     
+    def _send(self, send):
+        """
+        Sends an email with the given function, reconnecting and retrying if the server has dropped the connection.
+
+        Parameter:
+            send (callable): Sends the email using self.smtp
+        Returns: (str): "✓" if successful, otherwise the error message as a Send_Error classified as transient or not.
+        """
+        for attempt in range(SEND_ATTEMPTS):
+            try:
+                send()
+                self.last_used = time.monotonic()
+                return "✓"
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as err:
+                # Server dropped the connection, reconnect and retry
+                self.close()
+                if attempt == SEND_ATTEMPTS - 1:
+                    return smtp_error(err)
+                result = self.connect()
+                if result != "Success":
+                    return smtp_error(self.last_error, "Error: " + result)
+            except Exception as err:
+                return smtp_error(err)
+
     def send_message(self, msg):
         """
         Sends email to target recipient
@@ -55,8 +126,76 @@ class SMTP_Connection:
             msg (email.message.EmailMessage) : Email message containing the recipient, subject and body
         Returns: (str): Error messages from sending email. Empty if successful.
         """
+        return self._send(lambda: self.smtp.send_message(msg))
+
+    def send_prepared(self, sender, recipient, data):
+        """
+        Sends an already serialized email to target recipient
+
+        Parameter:
+            sender (str): Email address of sender
+            recipient (str): Email address of recipient
+            data (bytes): Serialized email message, with CRLF line endings
+        Returns: (str): "✓" if successful, otherwise the error message.
+        """
+        return self._send(lambda: self.smtp.sendmail(sender, [recipient], data))
+
+class SMTP_Connection_Pool:
+    """
+    SMTP_Connection_Pool class to share several authenticated SMTP connections to the same mail server.
+    Connections are opened lazily, health-checked after being idle, and reconnected when dropped.
+
+    Attributes:
+        size (int): Maximum number of concurrent connections (i.e. sessions) to the mail server
+
+    Sample usage:
+    smtp_pool = SMTP_Connection_Pool('smtp.gmail.com', 587, '<Your Email Address>', '<App Password Generated>', 3)
+    # Safe to call from several threads, up to size messages are sent concurrently
+    smtp_pool.send_message(<email crafted>)
+    """
+    def __init__(self, host, port, user, password, size=1):
+        self.size = size
+        self._connections = [SMTP_Connection(host, port, user, password) for _ in range(size)]
+        # Most recently used connections are reused first, so that unneeded ones are left to idle out
+        self._idle = LifoQueue()
+        for connection in self._connections:
+            self._idle.put(connection)
+
+    def send_message(self, msg):
+        """
+        Sends email to target recipient using an idle connection, waiting for one if all are in use.
+
+        Parameter:
+            msg (email.message.EmailMessage) : Email message containing the recipient, subject and body
+        Returns: (str): "✓" if successful, otherwise the error message.
+        """
+        return self._with_connection(lambda connection: connection.send_message(msg))
+
+    def send_prepared(self, sender, recipient, data):
+        """
+        Sends an already serialized email to target recipient using an idle connection.
+
+        Parameter:
+            sender (str): Email address of sender
+            recipient (str): Email address of recipient
+            data (bytes): Serialized email message, with CRLF line endings
+        Returns: (str): "✓" if successful, otherwise the error message.
+        """
+        return self._with_connection(lambda connection: connection.send_prepared(sender, recipient, data))
+
+    def _with_connection(self, send):
+        connection = self._idle.get()
         try:
-            self.smtp.send_message(msg)
-            return "✓"
-        except Exception as err:
-            return "Error: " + str(err)
+            result = connection.ensure_connected()
+            if result != "Success":
+                return smtp_error(connection.last_error, result)
+            return send(connection)
+        finally:
+            self._idle.put(connection)
+
+    def close(self):
+        """
+        Disconnects all connections with mail server.
+        """
+        for connection in self._connections:
+            connection.close()
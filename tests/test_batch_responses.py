@@ -0,0 +1,92 @@
+"""
+Tests parsing of Gmail API and Microsoft Graph batch responses into the result of each email, using stub responses.
+Run from the repository root with: python -m unittest discover tests
+"""
+from login import parse_gmail_batch_response, parse_graph_batch_response
+from retry_scheduler import Send_Error
+import unittest
+
+BOUNDARY = "batch_stub"
+CONTENT_TYPE = f"multipart/mixed; boundary={BOUNDARY}"
+
+"""
+Builds a stub Gmail batch response from (headers of the part, HTTP response) of each part.
+"""
+def gmail_batch(*parts) -> bytes:
+    body = ''.join(f"--{BOUNDARY}\r\nContent-Type: application/http\r\n{part_headers}\r\n{http_response}\r\n"
+                   for part_headers, http_response in parts)
+    return (body + f"--{BOUNDARY}--\r\n").encode()
+
+def gmail_part(i, status_line, headers="", content=""):
+    return f"Content-ID: <response-item{i}>\r\n", f"{status_line}\r\n{headers}\r\n{content}"
+
+SENT = 'HTTP/1.1 200 OK', "Content-Type: application/json\r\n", '{"id": "1", "labelIds": ["SENT"]}'
+
+class Gmail_Batch_Response_Test(unittest.TestCase):
+    def test_results_are_matched_to_requests_by_content_id(self):
+        content = gmail_batch(gmail_part(1, *SENT),
+                              gmail_part(0, "HTTP/1.1 400 Bad Request", "Content-Type: application/json\r\n", "{}"))
+        results = parse_gmail_batch_response(CONTENT_TYPE, content, 2)
+        self.assertEqual(results[1], "✓")
+        self.assertEqual(results[0], "Error: Bad Request")
+        self.assertFalse(results[0].transient)
+
+    def test_throttled_part_is_transient_with_retry_after(self):
+        content = gmail_batch(gmail_part(0, "HTTP/1.1 429 Too Many Requests", "Retry-After: 30\r\n", "{}"))
+        result = parse_gmail_batch_response(CONTENT_TYPE, content, 1)[0]
+        self.assertTrue(result.transient)
+        self.assertTrue(result.throttled)
+        self.assertEqual(result.retry_after, 30)
+
+    def test_accepted_but_not_sent_is_an_error(self):
+        content = gmail_batch(gmail_part(0, 'HTTP/1.1 200 OK', "", '{"id": "1", "labelIds": ["DRAFT"]}'))
+        self.assertEqual(parse_gmail_batch_response(CONTENT_TYPE, content, 1), ["Error: OK"])
+
+    def test_unreadable_parts_are_left_to_be_retried(self):
+        content = gmail_batch(("", "HTTP/1.1 200 OK\r\n\r\n{}"), # No Content-ID
+                              gmail_part(1, "not a status line"),
+                              gmail_part(7, *SENT), # Not a request of this batch
+                              gmail_part(2, *SENT))
+        results = parse_gmail_batch_response(CONTENT_TYPE, content, 3)
+        for result in results[:2]:
+            self.assertIsInstance(result, Send_Error)
+            self.assertTrue(result.transient)
+        self.assertEqual(results[2], "✓")
+
+    def test_missing_content_type_gives_every_email_a_transient_error(self):
+        results = parse_gmail_batch_response(None, gmail_batch(gmail_part(0, *SENT)), 2)
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(result.transient for result in results))
+
+    def test_non_multipart_response_gives_every_email_a_transient_error(self):
+        results = parse_gmail_batch_response("application/json", b'{"error": {}}', 1)
+        self.assertTrue(results[0].transient)
+
+class Graph_Batch_Response_Test(unittest.TestCase):
+    def test_results_are_matched_to_requests_by_id(self):
+        data = {"responses": [{"id": "1", "status": 202},
+                              {"id": "0", "status": 429, "headers": {"Retry-After": "5"}}]}
+        results = parse_graph_batch_response(data, 2)
+        self.assertEqual(results[1], "✓")
+        self.assertTrue(results[0].transient)
+        self.assertTrue(results[0].throttled)
+        self.assertEqual(results[0].retry_after, 5)
+
+    def test_permanent_error(self):
+        result = parse_graph_batch_response({"responses": [{"id": "0", "status": 400}]}, 1)[0]
+        self.assertEqual(result, "Error: Bad Request")
+        self.assertFalse(result.transient)
+
+    def test_unreadable_responses_are_left_to_be_retried(self):
+        data = {"responses": [{"status": 202}, {"id": "x", "status": 202}, {"id": "5", "status": 202},
+                              {"id": "1"}, "junk"]}
+        results = parse_graph_batch_response(data, 2)
+        self.assertTrue(all(result.transient for result in results))
+
+    def test_malformed_body(self):
+        for data in ({}, [], {"responses": "junk"}, None):
+            results = parse_graph_batch_response(data, 1)
+            self.assertTrue(results[0].transient)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+Tests sending a campaign with Email_Manager.
+Run from the repository root with: python -m unittest discover tests
+"""
+from email_manager import Email_Manager
+from prepared_email import Email_Metadata
+import unittest
+
+"""
+User sending every email successfully, without connecting to an email server.
+"""
+class Stub_User:
+    batch_size = 1
+    sends_outside_requests = False
+    rate_profile = "gmail_api"
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.sent = []
+
+    def get_id(self):
+        return self.user_id
+
+    def prepare_message(self, recipient, subject, body):
+        return recipient, body
+
+    def send_prepared_batch(self, prepared_list):
+        self.sent += prepared_list
+        return ["✓"] * len(prepared_list)
+
+def make_emails(count):
+    return [{"email": f"user{i}@example.com", "department": "A", "hash": f"{i:032x}", "id": str(i),
+             "subject": "Subject", "body": "Body"} for i in range(count)]
+
+class Email_Source_Error_Test(unittest.TestCase):
+    def test_failing_source_finishes_with_an_error_for_remaining_emails(self):
+        emails = make_emails(5)
+        def source():
+            yield from emails[:2]
+            raise OSError("Mail data file is gone")
+
+        manager = Email_Manager()
+        user = Stub_User("source-error@example.com")
+        manager.send_emails(user, source(), [Email_Metadata.from_mapping(email) for email in emails])
+        manager._thread.join(5)
+        self.assertFalse(manager.is_sending())
+        self.assertEqual(manager.results[:2], ["✓", "✓"])
+        self.assertEqual(len(manager.results), 5)
+        self.assertTrue(all(result.startswith("Error: ") and "Mail data file is gone" in result
+                            for result in manager.results[2:]))
+        results, finished = manager.wait_for_results(5, 0)
+        self.assertEqual((results, finished), ([], True))
+
+if __name__ == '__main__':
+    unittest.main()
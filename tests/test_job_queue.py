@@ -0,0 +1,82 @@
+"""
+Tests that the shared job queue leases jobs fairly across users, and that workers do not wait on one account.
+Run from the repository root with: python -m unittest discover tests
+"""
+from concurrent.futures import ThreadPoolExecutor
+from job_queue import Job_Queue
+from threading import Event
+from unittest import mock
+import worker
+import tempfile
+import unittest
+import time
+import os
+
+class Job_Queue_Lease_Test(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.queue = Job_Queue(os.path.join(folder.name, "jobs.db"))
+        self.addCleanup(self.queue._db.close)
+
+    def enqueue(self, campaign_id, user_id, count):
+        self.queue.enqueue(campaign_id, user_id, [(email_id, f"{campaign_id}-{email_id}", None)
+                                                  for email_id in range(count)])
+
+    def test_jobs_are_leased_in_enqueued_order(self):
+        # Campaign ids are random, so they say nothing about which campaign is older
+        self.enqueue("ffff", "user", 2)
+        time.sleep(0.01)
+        self.enqueue("0000", "user", 2)
+        leased = self.queue.lease("worker", 10)
+        self.assertEqual([(job[0], job[1]) for job in leased], [("ffff", 0), ("ffff", 1), ("0000", 0), ("0000", 1)])
+
+    def test_users_take_turns(self):
+        self.enqueue("large", "a", 100)
+        self.enqueue("small", "b", 2)
+        self.enqueue("other", "c", 1)
+        leased = self.queue.lease("worker", 6)
+        self.assertEqual([job[2] for job in leased], ["a", "b", "c", "a", "b", "a"])
+        self.assertEqual([job[1] for job in leased if job[2] == "a"], [0, 1, 2])
+
+    def test_skipped_users_are_not_leased(self):
+        self.enqueue("large", "a", 100)
+        self.enqueue("small", "b", 2)
+        leased = self.queue.lease("worker", 10, skip_users={"a"})
+        self.assertEqual([job[2] for job in leased], ["b", "b"])
+
+    def test_expired_leases_come_first(self):
+        self.enqueue("first", "a", 1)
+        self.queue.lease("stopped worker", 1, visibility_timeout=-1)
+        self.enqueue("second", "a", 1)
+        leased = self.queue.lease("worker", 1)
+        self.assertEqual((leased[0][0], leased[0][1]), ("first", 0))
+
+    def test_retries_wait_until_due(self):
+        self.enqueue("campaign", "a", 2)
+        leased = self.queue.lease("worker", 1)
+        self.queue.retry_later("worker", [(leased[0][0], leased[0][1], 1, 60)])
+        self.assertEqual([job[1] for job in self.queue.lease("worker", 10)], [1])
+
+class Worker_Test(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.queue = Job_Queue(os.path.join(folder.name, "jobs.db"))
+        self.addCleanup(self.queue._db.close)
+
+    def test_jobs_beyond_available_tokens_are_released(self):
+        self.queue.enqueue("campaign", "user", [(email_id, "prepared", None) for email_id in range(5)])
+        jobs = self.queue.lease("worker", 5)
+        user = mock.Mock(batch_size=10, send_prepared_batch=lambda prepared_list: ["✓"] * len(prepared_list))
+        rate_limiter = mock.Mock()
+        rate_limiter.try_acquire.side_effect = [2, 0]
+        with mock.patch.object(worker, "get_rate_limiter", return_value=rate_limiter), \
+             ThreadPoolExecutor(max_workers=2) as executor:
+            worker.send_user_jobs(self.queue, "worker", user, jobs, executor, Event())
+        self.assertEqual(self.queue.get_results("campaign", 0), ["✓", "✓"])
+        # The rest can be leased again at once, by any worker
+        self.assertEqual([job[1] for job in self.queue.lease("other worker", 5)], [2, 3, 4])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+"""
+Tests adaptation of the rate of sending (AIMD) to feedback from the email server, using a fake clock.
+Run from the repository root with: python -m unittest discover tests
+"""
+from rate_limiter import (DECREASE_INTERVAL, INCREASE_FRACTION, MIN_RATE_FRACTION, SENT, Shared_Token_Bucket,
+                          Token_Bucket)
+from retry_scheduler import Send_Error
+from threading import Event
+import tempfile
+import unittest
+import os
+
+THROTTLED = Send_Error("Error: Too Many Requests", transient=True, throttled=True)
+
+"""
+Token bucket whose clock only moves when advanced.
+"""
+class Fake_Clock_Bucket(Token_Bucket):
+    now = 1000.0
+
+    def _now(self):
+        return self.now
+
+class Fake_Clock_Shared_Bucket(Shared_Token_Bucket):
+    now = 1000.0
+
+    def _now(self):
+        return self.now
+
+class Token_Bucket_Test(unittest.TestCase):
+    def setUp(self):
+        self.bucket = Fake_Clock_Bucket(per_minute=60, burst=10)
+
+    def test_starts_at_quota_with_full_burst(self):
+        state = self.bucket.state()
+        self.assertEqual(state["per_minute"], 60)
+        self.assertEqual(state["tokens"], 10)
+        self.assertFalse(state["backing_off"])
+        self.assertEqual(self.bucket.acquire(4, Event()), 4)
+        self.assertEqual(self.bucket.acquire(20, Event()), 6)
+
+    def test_refills_at_rate(self):
+        self.bucket.acquire(10, Event())
+        self.bucket.now += 3
+        self.assertAlmostEqual(self.bucket.state()["tokens"], 3)
+
+    def test_throttling_halves_rate_once_per_interval(self):
+        self.bucket.feedback([THROTTLED, THROTTLED])
+        self.bucket.feedback([THROTTLED])
+        state = self.bucket.state()
+        self.assertAlmostEqual(state["per_minute"], 30)
+        self.assertTrue(state["backing_off"])
+        self.assertEqual(state["tokens"], 0)
+        self.bucket.now += DECREASE_INTERVAL
+        self.bucket.feedback([THROTTLED])
+        self.assertAlmostEqual(self.bucket.state()["per_minute"], 15)
+
+    def test_rate_does_not_drop_below_minimum(self):
+        for _ in range(20):
+            self.bucket.feedback([THROTTLED])
+            self.bucket.now += DECREASE_INTERVAL
+        self.assertAlmostEqual(self.bucket.state()["per_minute"], 60 * MIN_RATE_FRACTION)
+
+    def test_retry_after_pauses_sending(self):
+        self.bucket.feedback([Send_Error("Error: Too Many Requests", transient=True, retry_after=30, throttled=True)])
+        state = self.bucket.state()
+        self.assertEqual(state["paused_for"], 30)
+        self.assertGreaterEqual(state["next_token_in"], 30)
+        self.bucket.now += 29
+        self.assertEqual(self.bucket.state()["tokens"], 0)
+        self.bucket.now += 3
+        self.assertAlmostEqual(self.bucket.state()["tokens"], 1)
+
+    def test_successful_sends_raise_rate_additively(self):
+        self.bucket.feedback([THROTTLED])
+        self.bucket.feedback([SENT] * 15)
+        # Each minute of sends at 30 per minute adds INCREASE_FRACTION of the quota back: half a minute here
+        self.assertAlmostEqual(self.bucket.state()["per_minute"], 30 + 60 * INCREASE_FRACTION / 2)
+
+    def test_rate_does_not_rise_above_quota(self):
+        self.bucket.feedback([THROTTLED])
+        for _ in range(100):
+            self.bucket.feedback([SENT] * 30)
+        self.assertAlmostEqual(self.bucket.state()["per_minute"], 60)
+        self.assertFalse(self.bucket.state()["backing_off"])
+
+    def test_failures_do_not_raise_rate(self):
+        self.bucket.feedback([THROTTLED])
+        self.bucket.feedback(["Unable to connect or login. Make sure your credentials are correct."] * 10)
+        self.bucket.feedback([Send_Error("Error: Busy", transient=True)] * 10)
+        self.bucket.feedback([Send_Error("Error: No such user")] * 10)
+        self.assertAlmostEqual(self.bucket.state()["per_minute"], 30)
+
+    def test_rising_latency_counts_as_congestion(self):
+        for _ in range(10):
+            self.bucket.feedback([SENT], latency=0.5)
+        self.assertFalse(self.bucket.state()["backing_off"])
+        for _ in range(10):
+            self.bucket.feedback([SENT], latency=5)
+        state = self.bucket.state()
+        self.assertTrue(state["backing_off"])
+        self.assertGreater(state["latency"], 2 * state["base_latency"])
+
+    def test_low_latency_is_not_congestion(self):
+        for latency in (0.1, 0.3, 0.1, 0.4):
+            self.bucket.feedback([SENT], latency=latency)
+        self.assertFalse(self.bucket.state()["backing_off"])
+
+class Shared_Token_Bucket_Test(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.path = os.path.join(folder.name, "rate_limits.db")
+
+    def bucket(self):
+        bucket = Fake_Clock_Shared_Bucket(self.path, "user", per_minute=60, burst=10)
+        self.addCleanup(bucket._db.close)
+        return bucket
+
+    def test_processes_back_off_together(self):
+        first, second = self.bucket(), self.bucket()
+        first.feedback([THROTTLED])
+        self.assertAlmostEqual(second.state()["per_minute"], 30)
+        # The decrease is shared too, so throttling seen by another process in the same interval is not counted again
+        second.feedback([THROTTLED])
+        self.assertAlmostEqual(first.state()["per_minute"], 30)
+
+    def test_tokens_are_shared(self):
+        first, second = self.bucket(), self.bucket()
+        self.assertEqual(first.acquire(8, Event()), 8)
+        self.assertEqual(second.acquire(8, Event()), 2)
+
+if __name__ == '__main__':
+    unittest.main()
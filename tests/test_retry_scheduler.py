@@ -0,0 +1,157 @@
+"""
+Tests classification of send errors as transient or permanent, and scheduling of retries.
+Run from the repository root with: python -m unittest discover tests
+"""
+from email.utils import format_datetime
+from unittest import mock
+import retry_scheduler
+from retry_scheduler import (RETRY_MAX_DELAY, Retry_Scheduler, Send_Error, http_error, parse_retry_after, retry_delay,
+                             should_retry, smtp_error)
+import datetime
+import smtplib
+import unittest
+
+class Smtp_Error_Test(unittest.TestCase):
+    def test_4xx_reply_is_transient(self):
+        error = smtp_error(smtplib.SMTPDataError(452, b"Insufficient storage"))
+        self.assertTrue(error.transient)
+        self.assertFalse(error.throttled)
+        self.assertTrue(error.startswith("Error: "))
+
+    def test_throttling_reply_is_transient_and_throttled(self):
+        for code in (421, 451):
+            error = smtp_error(smtplib.SMTPSenderRefused(code, b"Try again later", "sender@example.com"))
+            self.assertTrue(error.transient)
+            self.assertTrue(error.throttled)
+
+    def test_5xx_reply_is_permanent(self):
+        for err in (smtplib.SMTPDataError(550, b"Mailbox unavailable"),
+                    smtplib.SMTPAuthenticationError(535, b"Bad credentials")):
+            error = smtp_error(err)
+            self.assertFalse(error.transient)
+            self.assertFalse(error.throttled)
+
+    def test_refused_recipients_are_transient_only_if_every_refusal_is(self):
+        transient = smtplib.SMTPRecipientsRefused({"a@example.com": (450, b"Busy"), "b@example.com": (421, b"Slow down")})
+        self.assertTrue(smtp_error(transient).transient)
+        self.assertTrue(smtp_error(transient).throttled)
+        mixed = smtplib.SMTPRecipientsRefused({"a@example.com": (450, b"Busy"), "b@example.com": (550, b"No such user")})
+        self.assertFalse(smtp_error(mixed).transient)
+        self.assertFalse(smtp_error(smtplib.SMTPRecipientsRefused({})).transient)
+
+    def test_dropped_connection_and_network_errors_are_transient(self):
+        for err in (smtplib.SMTPServerDisconnected("Connection unexpectedly closed"), ConnectionResetError(),
+                    TimeoutError()):
+            self.assertTrue(smtp_error(err).transient)
+
+    def test_other_errors_are_permanent(self):
+        self.assertFalse(smtp_error(ValueError("Bad address")).transient)
+        self.assertFalse(smtp_error(smtplib.SMTPNotSupportedError()).transient)
+
+    def test_message_overrides_error(self):
+        self.assertEqual(smtp_error(TimeoutError(), "Error: Timed out"), "Error: Timed out")
+
+class Http_Error_Test(unittest.TestCase):
+    def test_classification(self):
+        for status, transient, throttled in ((400, False, False), (401, False, False), (404, False, False),
+                                             (408, True, False), (429, True, True), (500, True, False),
+                                             (503, True, True), (504, True, False), (599, True, False)):
+            error = http_error(status, "Reason")
+            self.assertEqual(error, "Error: Reason")
+            self.assertEqual((error.transient, error.throttled), (transient, throttled), status)
+
+    def test_retry_after(self):
+        self.assertEqual(http_error(429, "Too Many Requests", "12").retry_after, 12)
+        self.assertIsNone(http_error(429, "Too Many Requests").retry_after)
+
+class Parse_Retry_After_Test(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after("30"), 30)
+        self.assertEqual(parse_retry_after("-5"), 0)
+
+    def test_http_date(self):
+        date = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=120)
+        self.assertAlmostEqual(parse_retry_after(format_datetime(date, usegmt=True)), 120, delta=2)
+        past = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+        self.assertEqual(parse_retry_after(format_datetime(past, usegmt=True)), 0)
+
+    def test_missing_or_invalid(self):
+        for value in (None, "", "soon"):
+            self.assertIsNone(parse_retry_after(value))
+
+class Retry_Delay_Test(unittest.TestCase):
+    def test_exponential_backoff_with_jitter(self):
+        for attempts in range(1, 5):
+            delay = retry_delay(attempts, base=2, max_delay=300)
+            self.assertGreaterEqual(delay, 2 * 2 ** (attempts - 1))
+            self.assertLess(delay, 2 * 2 ** (attempts - 1) + 2)
+
+    def test_capped_at_max_delay(self):
+        self.assertEqual(retry_delay(20, base=2, max_delay=300), 300)
+
+    def test_waits_at_least_retry_after(self):
+        self.assertEqual(retry_delay(1, retry_after=60, base=2, max_delay=300), 60)
+
+    def test_should_retry(self):
+        self.assertTrue(should_retry(Send_Error("Error: Busy", transient=True), 1, 4))
+        self.assertFalse(should_retry(Send_Error("Error: Busy", transient=True), 4, 4))
+        self.assertFalse(should_retry(Send_Error("Error: No such user"), 1, 4))
+        self.assertFalse(should_retry("Error: Busy", 1, 4))
+        self.assertFalse(should_retry("✓", 1, 4))
+
+"""
+Clock standing in for time.monotonic, which only moves when advanced.
+"""
+class Fake_Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+class Retry_Scheduler_Test(unittest.TestCase):
+    def setUp(self):
+        self.clock = Fake_Clock()
+        patcher = mock.patch.object(retry_scheduler, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = Retry_Scheduler(max_attempts=3)
+
+    def test_transient_failure_is_retried_once_due(self):
+        error = Send_Error("Error: Busy", transient=True, retry_after=30)
+        self.assertFalse(self.scheduler.handle_result((0, "prepared", None, 0), error))
+        self.assertEqual(self.scheduler.next_due_in(), 30)
+        self.assertEqual(self.scheduler.pop_due(10), [])
+        self.clock.now += 30
+        self.assertEqual(self.scheduler.pop_due(10), [(0, "prepared", None, 1)])
+        self.assertIsNone(self.scheduler.next_due_in())
+
+    def test_success_and_permanent_failure_are_final(self):
+        self.assertTrue(self.scheduler.handle_result((0, "prepared", None, 0), "✓"))
+        self.assertTrue(self.scheduler.handle_result((1, "prepared", None, 0), Send_Error("Error: No such user")))
+        self.assertEqual(self.scheduler.state(), {"retries_scheduled": 0, "dead_letters": 0})
+
+    def test_out_of_attempts_becomes_dead_letter(self):
+        error = Send_Error("Error: Busy", transient=True)
+        self.assertFalse(self.scheduler.handle_result((0, "prepared", None, 1), error))
+        self.assertTrue(self.scheduler.handle_result((0, "prepared", None, 2), error))
+        self.assertEqual(self.scheduler.state(), {"retries_scheduled": 1, "dead_letters": 1})
+        self.assertEqual(self.scheduler.take_dead_letters(), [(0, "prepared", error, 3)])
+        self.assertEqual(self.scheduler.dead_letters, [])
+
+    def test_pop_due_returns_earliest_first_up_to_count(self):
+        for email_id, retry_after in ((0, 50), (1, 10), (2, 30)):
+            self.scheduler.handle_result((email_id, "prepared", None, 0),
+                                         Send_Error("Error: Busy", transient=True, retry_after=retry_after))
+        self.clock.now += 60
+        self.assertEqual([item[0] for item in self.scheduler.pop_due(2)], [1, 2])
+        self.assertEqual([item[0] for item in self.scheduler.pop_due(2)], [0])
+
+    def test_clear_drops_scheduled_retries(self):
+        self.scheduler.handle_result((0, "prepared", None, 0), Send_Error("Error: Busy", transient=True))
+        self.scheduler.clear()
+        self.clock.now += RETRY_MAX_DELAY
+        self.assertEqual(self.scheduler.pop_due(10), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+"""
+Tests that a campaign interrupted by a restart is only resumed by one of the processes sharing the send journal.
+Run from the repository root with: python -m unittest discover tests
+"""
+from send_journal import Send_Journal, FINISHED
+import send_journal
+import tempfile
+import unittest
+import os
+
+class Send_Journal_Claim_Test(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.path = os.path.join(folder.name, "journal.db")
+
+    def journal(self):
+        journal = Send_Journal(self.path)
+        self.addCleanup(journal.close)
+        return journal
+
+    def test_only_one_process_claims_a_campaign(self):
+        stopped = self.journal()
+        stopped.start_campaign("campaign", "user", {})
+        stopped.close()
+        first, second = self.journal(), self.journal()
+        self.assertTrue(first.claim_campaign("campaign"))
+        self.assertFalse(second.claim_campaign("campaign"))
+        # Claiming again is harmless for the process that holds the claim
+        self.assertTrue(first.claim_campaign("campaign"))
+
+    def test_campaign_of_running_process_is_not_claimed(self):
+        running = self.journal()
+        running.start_campaign("campaign", "user", {})
+        self.assertFalse(self.journal().claim_campaign("campaign"))
+
+    def test_expired_claim_can_be_taken_over(self):
+        crashed, other = self.journal(), self.journal()
+        crashed.start_campaign("campaign", "user", {})
+        self.assertFalse(other.claim_campaign("campaign"))
+        original_timeout = send_journal.CLAIM_TIMEOUT
+        send_journal.CLAIM_TIMEOUT = -1
+        self.addCleanup(setattr, send_journal, "CLAIM_TIMEOUT", original_timeout)
+        crashed.renew_claims() # Renewed into the past, as if the process had stopped long ago
+        self.assertTrue(other.claim_campaign("campaign"))
+
+    def test_finished_campaign_is_not_claimed(self):
+        journal = self.journal()
+        journal.start_campaign("campaign", "user", {})
+        journal.finish_campaign("campaign", FINISHED)
+        journal.close()
+        other = self.journal()
+        self.assertFalse(other.claim_campaign("campaign"))
+        self.assertEqual(other.campaign_state("campaign"), FINISHED)
+        self.assertIsNone(other.campaign_state("unknown"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+"""
+Tests that Email_Manager backs off and retries when email servers throttle it, against local stub servers:
+an SMTP server replying 451 and 421, and a Gmail API batch endpoint replying 429 with Retry-After.
+Run from the repository root with: python -m unittest discover tests
+"""
+from email_manager import Email_Manager
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from login import SMTP_User, Google_User
+from prepared_email import Email_Metadata
+from smtp_connection import SMTP_Connection_Pool
+from threading import Thread
+from unittest import mock
+import login
+import rate_limiter
+import retry_scheduler
+import requests
+import unittest
+import socket
+import time
+import re
+try:
+    from aiosmtpd.controller import Controller
+    from aiosmtpd.smtp import AuthResult
+except ImportError:
+    Controller = None
+
+# Fast enough that waiting for tokens after backing off does not slow the tests down
+STUB_PROFILE = {"per_minute": 6000, "burst": 10}
+# Retries are backed off from this many seconds instead of retry_scheduler.RETRY_BASE, Retry-After is still honoured
+STUB_RETRY_BASE = 0.01
+
+def make_emails(count):
+    return [{"email": f"user{i}@example.com", "department": "A", "hash": f"{i:032x}", "id": str(i),
+             "subject": "Subject", "body": "Body"} for i in range(count)]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class Throttling_Test(unittest.TestCase):
+    def setUp(self):
+        patches = [mock.patch.dict(rate_limiter.RATE_PROFILES, {"stub": STUB_PROFILE}),
+                   mock.patch.dict(rate_limiter._limiters, clear=True),
+                   mock.patch.object(retry_scheduler, "retry_delay",
+                                     partial(retry_scheduler.retry_delay, base=STUB_RETRY_BASE))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    """
+    Sends emails with a new Email_Manager and waits until all of them have a result.
+    """
+    def send(self, user, emails):
+        manager = Email_Manager()
+        manager.send_emails(user, iter(emails), [Email_Metadata.from_mapping(email) for email in emails])
+        manager._thread.join(30)
+        self.assertFalse(manager.is_sending())
+        return manager
+
+"""
+SMTP handler throttling the first attempt of some recipients with 451 (to RCPT) or 421 (to DATA).
+"""
+class Throttling_SMTP_Handler:
+    def __init__(self, throttled_rcpt, throttled_data):
+        self.throttled_rcpt = set(throttled_rcpt)
+        self.throttled_data = set(throttled_data)
+        self.attempts = {}
+        self.delivered = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        self.attempts[address] = self.attempts.get(address, 0) + 1
+        if address in self.throttled_rcpt:
+            self.throttled_rcpt.discard(address)
+            return "451 4.7.1 Too many messages, slow down"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        throttled = self.throttled_data & set(envelope.rcpt_tos)
+        if throttled:
+            self.throttled_data -= throttled
+            return "421 4.7.0 Try again later, closing connection"
+        self.delivered += envelope.rcpt_tos
+        return "250 Message accepted for delivery"
+
+@unittest.skipIf(Controller is None, "aiosmtpd is not installed")
+class SMTP_Throttling_Test(Throttling_Test):
+    def setUp(self):
+        super().setUp()
+        self.handler = Throttling_SMTP_Handler(["user0@example.com"], ["user1@example.com"])
+        self.port = free_port()
+        controller = Controller(self.handler, hostname="127.0.0.1", port=self.port, auth_require_tls=False,
+                                authenticator=lambda *_: AuthResult(success=True))
+        controller.start()
+        self.addCleanup(controller.stop)
+
+    def test_throttled_emails_are_retried_and_rate_backs_off(self):
+        user = SMTP_User("sender@gmail.com", "password")
+        user.email_sender = SMTP_Connection_Pool("127.0.0.1", self.port, user.email, user.password, 2)
+        self.addCleanup(user.email_sender.close)
+        user.rate_profile = "stub"
+        manager = self.send(user, make_emails(3))
+
+        self.assertEqual(manager.results, ["✓", "✓", "✓"])
+        self.assertEqual(sorted(self.handler.delivered), ["user0@example.com", "user1@example.com", "user2@example.com"])
+        self.assertEqual(self.handler.attempts, {"user0@example.com": 2, "user1@example.com": 2, "user2@example.com": 1})
+        self.assertEqual(manager.retry_state()["dead_letters"], 0)
+        state = manager.rate_limiter.state()
+        self.assertTrue(state["backing_off"])
+        self.assertLess(state["per_minute"], state["max_per_minute"])
+
+"""
+Stub of the Gmail API batch endpoint, throttling its first request with 429 and Retry-After,
+then sending every email of later requests.
+"""
+class Throttling_Gmail_Handler(BaseHTTPRequestHandler):
+    retry_after = 1
+    requests = [] # Time of each request
+
+    def do_POST(self):
+        content = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        self.requests.append(time.monotonic())
+        if len(self.requests) == 1:
+            self.send_response(429)
+            self.send_header("Retry-After", str(self.retry_after))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        parts = ''.join(f"--stub\r\nContent-Type: application/http\r\nContent-ID: <response-item{i}>\r\n\r\n"
+                        'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n{"labelIds": ["SENT"]}\r\n'
+                        for i in re.findall(r"Content-ID: <item(\d+)>", content))
+        body = (parts + "--stub--\r\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/mixed; boundary=stub")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+"""
+Requests session sending to urls relative to a base url, like the OAuth sessions of Flask-Dance.
+"""
+class Stub_Session(requests.Session):
+    authorized = True
+
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url
+
+    def request(self, method, url, *args, **kwargs):
+        return super().request(method, self.base_url + url, *args, **kwargs)
+
+class Gmail_Throttling_Test(Throttling_Test):
+    def setUp(self):
+        super().setUp()
+        Throttling_Gmail_Handler.requests = []
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Throttling_Gmail_Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        session = Stub_Session(f"http://127.0.0.1:{server.server_port}")
+        self.addCleanup(session.close)
+        with mock.patch.object(login, "google", mock.Mock(_get_current_object=lambda: session)):
+            self.user = Google_User("sender@gmail.com")
+        self.user.rate_profile = "stub"
+
+    def test_retry_after_pauses_sending_and_rate_backs_off(self):
+        manager = self.send(self.user, make_emails(2))
+
+        self.assertEqual(manager.results, ["✓", "✓"])
+        # Retries may become due a moment apart, and be sent in separate requests,
+        # but nothing is sent again before the server's Retry-After has passed
+        first_request, *later_requests = Throttling_Gmail_Handler.requests
+        self.assertTrue(later_requests)
+        self.assertGreaterEqual(min(later_requests) - first_request, Throttling_Gmail_Handler.retry_after)
+        self.assertEqual(manager.retry_state()["dead_letters"], 0)
+        state = manager.rate_limiter.state()
+        self.assertTrue(state["backing_off"])
+        self.assertLess(state["per_minute"], state["max_per_minute"])
+
+if __name__ == '__main__':
+    unittest.main()
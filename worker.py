@@ -0,0 +1,149 @@
+"""
+Standalone worker that sends emails enqueued by the application in a shared job queue.
+Run the application with SEND_QUEUE_PATH set, then start any number of workers on the same machine:
+
+python worker.py --queue jobs.db
+
+Workers lease jobs from the queue, so each email is sent by one worker at a time, and emails leased by a
+worker that stopped are sent by another one once their lease expires. Rate limits of each account are
+shared by all workers (and the application) through the queue's database. Workers never wait on the rate limit
+of one account: jobs beyond it are released, and accounts without tokens are skipped, so other users' campaigns
+are sent in the meantime.
+Emails failing with a transient error are queued again with backoff, and kept as dead jobs once out of attempts.
+Only users that can be sent from outside their requests (i.e. SMTP users) are sent by workers.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from email_manager import SEND_WORKERS
+from job_queue import Job_Queue, JOB_QUEUE_PATH, VISIBILITY_TIMEOUT
+from login import User
+from rate_limiter import get_rate_limiter
+from retry_scheduler import Send_Error, should_retry, retry_delay
+from threading import Event
+import argparse
+import signal
+import socket
+import time
+import os
+
+# Seconds to wait before checking an empty queue again
+POLL_INTERVAL = 1
+# Maximum number of jobs leased at a time
+LEASE_SIZE = 50
+
+"""
+Sends jobs of one user within the account's rate limit, completing each batch as it is sent.
+Jobs beyond the tokens currently available are released, to be leased again once the account has tokens.
+Jobs whose lease is lost while sending are left to the worker that now holds them.
+Parameters:
+    queue (Job_Queue): The queue the jobs were leased from.
+    worker_id (str): Id of this worker.
+    user (User): The user sending the jobs.
+    jobs (list[tuple]): (campaign id, email id, user id, prepared email, attempts so far) of each job.
+    executor (ThreadPoolExecutor): Executor to send batches of emails concurrently with.
+    stop (threading.Event): Stops sending once set, releasing the jobs not sent yet.
+"""
+def send_user_jobs(queue, worker_id, user, jobs, executor, stop, visibility_timeout=VISIBILITY_TIMEOUT):
+    rate_limiter = get_rate_limiter(user, queue.path)
+    batch_size = user.batch_size
+    while jobs:
+        allowed = 0 if stop.is_set() else rate_limiter.try_acquire(len(jobs))
+        if not allowed:
+            queue.release(worker_id, [(campaign_id, email_id) for campaign_id, email_id, _, _, _ in jobs])
+            return
+        batch, jobs = jobs[:allowed], jobs[allowed:]
+        held = queue.renew(worker_id, [(campaign_id, email_id) for campaign_id, email_id, _, _, _ in batch],
+                           visibility_timeout)
+        batch = [job for job in batch if (job[0], job[1]) in held]
+
+        chunks = [batch[i:i + batch_size] for i in range(0, len(batch), batch_size)]
+        futures = [executor.submit(send_batch, user, rate_limiter, [prepared for _, _, _, prepared, _ in chunk])
+                   for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            try:
+                results = future.result()
+            except Exception as err:
+                results = [Send_Error("Error: " + str(err), transient=isinstance(err, OSError))] * len(chunk)
+            finish_jobs(queue, worker_id, chunk, results)
+
+"""
+Sends a batch of prepared emails, adapting the shared rate limit to throttling replies and latency.
+"""
+def send_batch(user, rate_limiter, prepared_list):
+    started = time.monotonic()
+    results = user.send_prepared_batch(prepared_list)
+    rate_limiter.feedback(results, time.monotonic() - started)
+    return results
+
+"""
+Records the results of sent jobs. Jobs that failed with a transient error are queued again to be retried
+after a backoff, or recorded as dead once out of attempts.
+"""
+def finish_jobs(queue, worker_id, jobs, results):
+    completed, retries, dead = [], [], []
+    for (campaign_id, email_id, _, _, attempts), result in zip(jobs, results):
+        attempts += 1
+        if should_retry(result, attempts):
+            retries.append((campaign_id, email_id, attempts, retry_delay(attempts, result.retry_after)))
+        elif isinstance(result, Send_Error) and result.transient:
+            dead.append((campaign_id, email_id, attempts, result))
+        else:
+            completed.append((campaign_id, email_id, result))
+    if retries:
+        queue.retry_later(worker_id, retries)
+    if dead:
+        queue.dead_letter(worker_id, dead)
+    if completed:
+        queue.complete(worker_id, completed)
+
+"""
+Leases and sends jobs until stop is set.
+Parameters:
+    queue (Job_Queue): The queue to lease jobs from.
+    worker_id (str): Unique id of this worker.
+    stop (threading.Event): Stops the worker once set.
+"""
+def run_worker(queue, worker_id, stop, visibility_timeout=VISIBILITY_TIMEOUT):
+    users = {}
+    with ThreadPoolExecutor(max_workers=SEND_WORKERS) as executor:
+        while not stop.is_set():
+            # Accounts without tokens are skipped, rather than holding their jobs while waiting on the rate limit
+            skip_users = {user_id for user_id, user in users.items() if user is not None and user.sends_outside_requests
+                          and get_rate_limiter(user, queue.path).state()["next_token_in"] > 0}
+            jobs = queue.lease(worker_id, LEASE_SIZE, visibility_timeout, skip_users)
+            if not jobs:
+                stop.wait(POLL_INTERVAL)
+                continue
+
+            jobs_by_user = {}
+            for job in jobs:
+                jobs_by_user.setdefault(job[2], []).append(job)
+            for user_id, user_jobs in jobs_by_user.items():
+                if stop.is_set():
+                    queue.release(worker_id, [(campaign_id, email_id) for campaign_id, email_id, _, _, _ in user_jobs])
+                    continue
+                if user_id not in users:
+                    users[user_id] = User.load(user_id)
+                user = users[user_id]
+                if user is None or not user.sends_outside_requests:
+                    queue.complete(worker_id, [(campaign_id, email_id, "Error: Sender account could not be loaded")
+                                               for campaign_id, email_id, _, _, _ in user_jobs])
+                    continue
+                send_user_jobs(queue, worker_id, user, user_jobs, executor, stop, visibility_timeout)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Sends emails enqueued by the application.")
+    arg_parser.add_argument("--queue", default=os.environ.get("SEND_QUEUE_PATH", JOB_QUEUE_PATH),
+                            help="Path of the shared job queue database.")
+    arg_parser.add_argument("--visibility-timeout", type=float, default=VISIBILITY_TIMEOUT,
+                            help="Seconds after which emails leased by a stopped worker are sent by another one.")
+    args = arg_parser.parse_args()
+
+    stop = Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    print(f"Worker {worker_id} sending from {args.queue}")
+    run_worker(Job_Queue(args.queue), worker_id, stop, args.visibility_timeout)
+
+if __name__ == '__main__':
+    main()